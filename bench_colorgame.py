@@ -0,0 +1,389 @@
+"""Deterministic load test for the ColorGame cog.
+
+Drives the hot commands (start_bet, close_bets, roll_colors, leaderboard,
+gift_coins, balance, view_profits) against fake Discord objects and a mongomock
+store, or a real deployment with ``--uri``, and reports latency percentiles
+and Mongo round-trips per command. The workload is seeded, so two runs with
+the same arguments issue exactly the same commands::
+
+    python bench_colorgame.py --users 5000 --bets 2000 --rounds 5 --latency-ms 1
+
+``--processes`` runs several cogs in shared mode, each with its own
+connection, against a replica set and spreads the commands over them, the
+way bet intake is spread over processes in a sharded deployment::
+
+    python bench_colorgame.py --uri "mongodb://localhost:27017/?replicaSet=rs0" --processes 3
+
+``--stress`` mixes gifts, withdrawals approved at once, and balance
+adjustments into every bet burst. It then checks that no balance went
+negative and that the coins add up: the starting total, plus successful
+adjustments, minus approved withdrawals, minus stakes, plus the payouts the
+bench computes from the rolled colors. It exits with status 1 if not::
+
+    python bench_colorgame.py --stress 200 --concurrency 200 --users 100
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import random
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+
+from colorgame import COLORS, ColorGame, InvocationStats, OutputPipeline
+from colorgame_store import MongoStore, current_invocation
+
+ids = itertools.count(10 ** 17)
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None):
+        self.id = next(ids)
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.replies = []
+
+    async def reply(self, content=None, embed=None):
+        self.replies.append(embed or content)
+        return await self.channel.send(content, embed=embed)
+
+    async def add_reaction(self, emoji):
+        pass
+
+    async def remove_reaction(self, emoji, member):
+        pass
+
+    async def clear_reactions(self):
+        pass
+
+    async def edit(self, content=None, embed=None):
+        self.content = content if content is not None else self.content
+        self.embed = embed if embed is not None else self.embed
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.sent = 0
+        self.partial_messages = {}
+
+    async def send(self, content=None, embed=None):
+        self.sent += 1
+        return FakeMessage(self, content, embed)
+
+    def get_partial_message(self, message_id):
+        if message_id not in self.partial_messages:
+            self.partial_messages[message_id] = FakeMessage(self)
+        return self.partial_messages[message_id]
+
+
+class FakeClient:
+    def __init__(self, channels):
+        self.channels = {channel.id: channel for channel in channels}
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+
+class FakeRole:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeMember:
+    def __init__(self, guild, user_id):
+        self.guild = guild
+        self.id = user_id
+        self.display_name = f"player{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.roles = [FakeRole("admin")]
+
+
+class FakeReaction:
+    """Raw reaction payload, as ReactionRouter.dispatch receives it."""
+
+    def __init__(self, message_id, member, emoji):
+        self.message_id = message_id
+        self.member = member
+        self.user_id = member.id
+        self.emoji = emoji
+
+
+class FakeGuild:
+    """Guild whose member cache only holds ``cached`` of its members, like a large real guild."""
+
+    def __init__(self, guild_id, user_ids, cached=0.5):
+        self.id = guild_id
+        self.members = {user_id: FakeMember(self, user_id) for user_id in user_ids}
+        self.cached = set(user_ids[:int(len(user_ids) * cached)])
+        self.queries = 0
+
+    def get_member(self, user_id):
+        return self.members.get(user_id) if user_id in self.cached else None
+
+    async def query_members(self, user_ids=None, limit=5, cache=True):
+        self.queries += 1
+        await asyncio.sleep(0)
+        return [self.members[user_id] for user_id in user_ids if user_id in self.members]
+
+
+class FakeContext:
+    def __init__(self, guild, channel, author):
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.message = FakeMessage(channel)
+        self.replies = []
+
+    async def send(self, content=None, embed=None):
+        self.replies.append(embed or content)
+        return await self.channel.send(content, embed=embed)
+
+    async def reply(self, content=None, embed=None):
+        self.replies.append(embed or content)
+        return await self.channel.send(content, embed=embed)
+
+
+class Recorder:
+    """Latency samples and Mongo round-trips per command."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.db_calls = Counter()
+        self.calls = defaultdict(Counter)
+
+    async def invoke(self, name, command, cog, ctx, *args):
+        invocation = InvocationStats()
+        token = current_invocation.set(invocation)
+        try:
+            await getattr(command, "callback", command)(cog, ctx, *args)  # A command, or a step such as withdraw
+        finally:
+            self.latencies[name].append(time.perf_counter() - invocation.started)
+            current_invocation.reset(token)
+        self.db_calls[name] += invocation.db_calls
+        self.calls[name].update(invocation.calls)
+
+    def rows(self):
+        for name, samples in self.latencies.items():
+            ordered = sorted(samples)
+            yield {
+                "command": name,
+                "count": len(ordered),
+                "p50_ms": percentile(ordered, 50) * 1000,
+                "p95_ms": percentile(ordered, 95) * 1000,
+                "p99_ms": percentile(ordered, 99) * 1000,
+                "max_ms": ordered[-1] * 1000,
+                "mean_ms": statistics.fmean(ordered) * 1000,
+                "db_calls": self.db_calls[name] / len(ordered),
+                "top_calls": dict(self.calls[name].most_common(3)),
+            }
+
+
+def percentile(ordered, pct):
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+async def seed(store, user_ids, balance, history, rng):
+    await store.users.insert_many([{"_id": user_id, "balance": balance} for user_id in user_ids])
+    if history:
+        await store.roll_history.insert_many([{"results": tuple(rng.choice(COLORS) for _ in range(3)),
+                                               "date": datetime.datetime(2024, 1, 1)}
+                                              for _ in range(history)])
+
+
+def titled(ctx, title):
+    return any(getattr(reply, "title", None) == title for reply in ctx.replies)
+
+
+async def withdraw(cog, ctx, amount):
+    """``.withdraw``, then an admin's ✅ on the request, as soon as it is posted."""
+    await cog.withdraw_request.callback(cog, ctx, amount)
+    request = await cog.store.approvals.find_one({"request_message_id": ctx.message.id})
+    if request:
+        await cog.reactions.dispatch(FakeReaction(request["_id"], ctx.author, '✅'))
+        ctx.replies.extend(ctx.channel.get_partial_message(ctx.message.id).replies)
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    if args.uri:
+        store = MongoStore.from_uri(args.uri, database=args.database, max_workers=args.workers)
+        for name in store.collection_names:
+            await store.run(store.db.drop_collection, name)
+    else:
+        store = MongoStore.in_memory(max_workers=args.workers, latency=args.latency_ms / 1000)
+    await store.ensure_indexes()
+    stores = [store] + [MongoStore.from_uri(args.uri, database=args.database, max_workers=args.workers)
+                        for _ in range(args.processes - 1)]
+
+    user_ids = list(range(1, args.users + 1))
+    guild = FakeGuild(1, user_ids, cached=args.cached)
+    members = guild.members
+    await seed(store, user_ids, args.balance, args.history, rng)
+
+    shared = args.processes > 1
+    channels = [FakeChannel(2 + index) for index in range(args.tables)]
+    client = FakeClient(channels)
+    cogs = [ColorGame(client, process_store, shared=shared) for process_store in stores]
+    admin_channel = FakeChannel(cogs[0].admin_channel_id)
+    client.channels[admin_channel.id] = admin_channel
+    for cog in cogs:
+        if shared:
+            await cog.cog_load()
+        if not args.pace:
+            cog.output = OutputPipeline(rate=10 ** 9, per=1.0)
+    cog = cogs[0]
+    recorder = Recorder()
+    total = args.users * args.balance  # What the balances should add up to, kept for --stress
+    stress_contexts = []
+
+    async def burst(calls):
+        for start in range(0, len(calls), args.concurrency):
+            await asyncio.gather(*(recorder.invoke(*call) for call in calls[start:start + args.concurrency]))
+
+    async def settled(channel, state):
+        """Wait until every process has seen the table's round reach ``state`` through its change stream."""
+        while not all(state(other.table(channel.id, guild.id)) for other in cogs):
+            await asyncio.sleep(0.005)
+
+    async def play(channel, rng):
+        """Every round at one table; tables run concurrently, each from its own seeded generator."""
+        nonlocal total
+        table = cog.table(channel.id, guild.id)
+        for other in cogs:
+            other.table(channel.id, guild.id).bet_writes.max_batch = args.batch
+        admin = FakeContext(guild, channel, members[user_ids[0]])
+        for _ in range(args.rounds):
+            await table.open_round()
+            await settled(channel, lambda other: other.betting_open)
+            calls = []
+            for _ in range(args.bets):
+                process = rng.choice(cogs)
+                calls.append(("start_bet", process.start_bet, process,
+                              FakeContext(guild, channel, members[rng.choice(user_ids)]),
+                              rng.randint(5, 100), rng.choice(COLORS)))
+            for _ in range(args.stress):
+                process = rng.choice(cogs)
+                ctx = FakeContext(guild, channel, members[rng.choice(user_ids)])
+                calls.append(("gift_coins", process.gift_coins, process, ctx, members[rng.choice(user_ids)],
+                              rng.randint(1, args.balance // 2)))
+                ctx = FakeContext(guild, channel, members[rng.choice(user_ids)])
+                amount = rng.randint(1, args.balance // 2)
+                calls.append(("withdraw", withdraw, process, ctx, amount))
+                stress_contexts.append(("Approved!", -amount, ctx))
+                ctx = FakeContext(guild, channel, admin.author)
+                amount = rng.choice((-1, 1)) * rng.randint(1, args.balance // 2)
+                calls.append(("adjust_balance", process.adjust_balance, process, ctx,
+                              members[rng.choice(user_ids)], amount))
+                stress_contexts.append(("Balance Adjustment", amount, ctx))
+            if args.stress:
+                rng.shuffle(calls)
+            await burst(calls)
+            await recorder.invoke("close_bets", cog.close_bets, cog, admin)
+            results = [rng.choice(COLORS) for _ in range(3)]
+            rows = table.current_round.ledger.rows()
+            await recorder.invoke("roll_colors", cog.roll_colors, cog, admin, *results)
+            await settled(channel, lambda other: other.current_round is None)
+            for _, color, amount in rows:
+                hits = results.count(color)
+                total += amount * hits if hits else -amount  # Paid the stake plus one per hit, or lost it
+
+            calls = []
+            for _ in range(args.reads):
+                process = rng.choice(cogs)
+                ctx = FakeContext(guild, channel, members[rng.choice(user_ids)])
+                calls.append(("leaderboard", process.leaderboard, process, ctx))
+                calls.append(("gift_coins", process.gift_coins, process, ctx, members[rng.choice(user_ids)],
+                              rng.randint(1, 20)))
+                calls.append(("balance", process.balance, process, ctx))
+                calls.append(("view_profits", process.view_profits, process, admin))
+            rng.shuffle(calls)
+            await burst(calls)
+
+    started = time.perf_counter()
+    round_trips = sum(process_store.round_trips for process_store in stores)
+    await asyncio.gather(*(play(channel, random.Random(f"{args.seed}:{index}"))
+                           for index, channel in enumerate(channels)))
+    elapsed = time.perf_counter() - started
+
+    hits = sum(other.balances.cache.hits for other in cogs)
+    lookups = hits + sum(other.balances.cache.misses for other in cogs)
+    stress = None
+    if args.stress:
+        total += sum(amount for title, amount, ctx in stress_contexts if titled(ctx, title))
+        balances = [user["balance"] for user in await store.users.find({}, {"balance": 1})]
+        stress = {"expected_total": total, "total": sum(balances),
+                  "negative": sum(1 for balance in balances if balance < 0)}
+        stress["ok"] = stress["total"] == total and not stress["negative"]
+    for other in cogs:
+        await other.cog_unload()
+    return {
+        "args": vars(args),
+        "elapsed_s": elapsed,
+        "round_trips": sum(process_store.round_trips for process_store in stores) - round_trips,
+        "messages_sent": sum(channel.sent for channel in channels),
+        "member_queries": guild.queries,
+        "balance_cache": {"hits": hits, "lookups": lookups, "hit_rate": hits / lookups if lookups else 0.0},
+        "commands": list(recorder.rows()),
+        "stress": stress,
+    }
+
+
+def report(result):
+    print(f"{result['elapsed_s']:.2f}s, {result['round_trips']} Mongo round-trips, "
+          f"{result['messages_sent']} messages, {result['member_queries']} member queries, "
+          f"{result['balance_cache']['hit_rate']:.0%} balance cache hits")
+    print(f"{'command':<14}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'db/call':>9}")
+    for row in result["commands"]:
+        print(f"{row['command']:<14}{row['count']:>7}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+              f"{row['p99_ms']:>10.2f}{row['max_ms']:>10.2f}{row['db_calls']:>9.1f}")
+    stress = result["stress"]
+    if stress:
+        print(f"stress: balances total {stress['total']}, expected {stress['expected_total']}, "
+              f"{stress['negative']} negative: {'OK' if stress['ok'] else 'FAILED'}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000, help="registered players")
+    parser.add_argument("--bets", type=int, default=500, help="bets per round and table")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds per table")
+    parser.add_argument("--tables", type=int, default=1, help="channels playing concurrently")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="cogs sharing round state through change streams (needs --uri to a replica set)")
+    parser.add_argument("--reads", type=int, default=50,
+                        help="leaderboard, gift_coins, balance and view_profits calls each per round")
+    parser.add_argument("--history", type=int, default=1000, help="roll_history documents to seed")
+    parser.add_argument("--balance", type=int, default=10000, help="starting balance per player")
+    parser.add_argument("--stress", type=int, default=0,
+                        help="gift, withdraw-and-approve and adjust_balance calls each, mixed into every bet burst")
+    parser.add_argument("--concurrency", type=int, default=50, help="commands in flight at once")
+    parser.add_argument("--cached", type=float, default=0.5, help="share of members in the guild cache")
+    parser.add_argument("--batch", type=int, default=1, help="bet write batch size, see .set_bet_batching")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated round-trip for mongomock")
+    parser.add_argument("--workers", type=int, default=8, help="Mongo thread pool size")
+    parser.add_argument("--pace", action="store_true", help="keep the per-channel send rate limit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--uri", help="run against this MongoDB instead of mongomock (drops the database's collections)")
+    parser.add_argument("--database", default="colorgame_bench")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args(argv)
+    if args.processes > 1 and not args.uri:
+        parser.error("--processes needs --uri pointing at a replica set; mongomock has no change streams")
+
+    result = asyncio.run(run(args))
+    report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    if result["stress"] and not result["stress"]["ok"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,1080 @@
 import asyncio
+import bisect
+import contextlib
 import datetime
+import io
+import logging
 import os
-
-from pymongo import MongoClient, UpdateOne
-from discord.ext import commands
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from discord.ext import commands, tasks
 import discord
 
-# MongoDB setup
-cluster = MongoClient(os.getenv('MONGODB_URI'))
-db = cluster["discord"]
-users_collection = db["users"]
-bets_collection = db["bets"]
-roll_history_collection = db["roll_history"]
-given_coins_collection = db["given_coins"]
-lost_bets_collection = db["lost_bets"]
-redeemed_coins_collection = db["redeemed_coins"]
+from colorgame_archive import Exporter, SeasonArchiver
+from colorgame_ledger import BalanceService, TransactionLedger
+from colorgame_store import ChangeFeed, MongoConfig, MongoStore, WriteBuffer, current_invocation, record_call
+
+log = logging.getLogger(__name__)
+
+COLORS = ('red', 'purple', 'pink', 'orange', 'blue', 'green')
+
+
+class Histogram:
+    """Fixed-bucket histogram with Prometheus ``le`` semantics."""
+
+    latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    count_buckets = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        """Yield ``(le, count of observations <= le)``, ending with ``("+Inf", count)``."""
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        """Estimate the ``q`` quantile by interpolating inside its bucket, like ``histogram_quantile``."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        lower, seen = 0.0, 0
+        for bound, count in zip(self.buckets, self.counts):
+            if seen + count >= rank:
+                estimate = lower + (bound - lower) * (rank - seen) / count if count else lower
+                return min(estimate, self.max)
+            lower, seen = bound, seen + count
+        return self.max
+
+
+class InvocationStats:
+    """Mongo and gateway calls made by one command invocation, keyed ``collection.op``."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.calls = Counter()
+        self.seconds = Counter()
+        self.timings = []
+
+    def record(self, key, seconds):
+        self.calls[key] += 1
+        self.seconds[key] += seconds
+        self.timings.append((key, seconds))
+
+    @property
+    def db_calls(self):
+        return sum(count for key, count in self.calls.items() if not key.startswith("gateway."))
+
+
+class PerfMetrics:
+    """Per-command latency, Mongo and gateway call timings and event-loop lag for ``.perf``."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = datetime.datetime.now()
+        self.commands = {}
+        self.command_calls = {}
+        self.ops = {}
+        self.errors = Counter()
+        self.loop_lag = Histogram()
+
+    def begin(self):
+        invocation = InvocationStats()
+        current_invocation.set(invocation)
+        return invocation
+
+    def finish(self, name, invocation, failed=False):
+        self.commands.setdefault(name, Histogram()).observe(time.perf_counter() - invocation.started)
+        self.command_calls.setdefault(name, Histogram(Histogram.count_buckets)).observe(invocation.db_calls)
+        for key, seconds in invocation.timings:
+            self.ops.setdefault(key, Histogram()).observe(seconds)
+        if failed:
+            self.errors[name] += 1
+
+    async def sample_loop_lag(self, interval=0.5):
+        """Record how late each ``interval`` sleep wakes up; blocking calls on the loop show up here."""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(0.0, loop.time() - expected))
+
+    def render_prometheus(self, gauges=None):
+        """Prometheus text exposition of every histogram plus ``gauges`` (``{name: value}``)."""
+        lines = []
+
+        def histogram(name, help, labelled, label):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            for value, hist in sorted(labelled.items()):
+                labels = f'{label}="{value}",' if label else ""
+                for bound, count in hist.cumulative():
+                    lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {count}')
+                suffix = f'{{{labels.rstrip(",")}}}' if label else ""
+                lines.append(f"{name}_sum{suffix} {hist.sum}")
+                lines.append(f"{name}_count{suffix} {hist.count}")
+
+        histogram("colorgame_command_seconds", "Command latency from before_invoke to after_invoke.",
+                  self.commands, "command")
+        histogram("colorgame_command_db_calls", "Mongo round-trips per command invocation.",
+                  self.command_calls, "command")
+        histogram("colorgame_call_seconds", "Mongo and gateway call latency made from commands.", self.ops, "op")
+        histogram("colorgame_event_loop_lag_seconds", "Event loop wake-up delay.", {"": self.loop_lag}, None)
+        lines.append("# TYPE colorgame_command_errors_total counter")
+        for name, count in sorted(self.errors.items()):
+            lines.append(f'colorgame_command_errors_total{{command="{name}"}} {count}')
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class RoundLedger:
+    """Per-user stakes by color for one round, kept current as bets are placed and canceled."""
+
+    def __init__(self, colors=COLORS):
+        self.colors = tuple(colors)
+        self.color_index = {color: i for i, color in enumerate(self.colors)}
+        self.user_bets = {}
+
+    def add(self, user_id, color, amount):
+        i = self.color_index[color]
+        self.user_bets.setdefault(user_id, [0] * len(self.colors))[i] += amount
+
+    def remove(self, user_id, color, amount):
+        self.add(user_id, color, -amount)
+        if not any(self.user_bets[user_id]):
+            del self.user_bets[user_id]
+
+    def user_total(self, user_id):
+        return sum(self.user_bets.get(user_id, ()))
+
+    def rows(self):
+        """Yield ``(user_id, color, amount)`` for every non-empty position."""
+        for user_id, amounts in self.user_bets.items():
+            for color, amount in zip(self.colors, amounts):
+                if amount:
+                    yield user_id, color, amount
+
+    def __len__(self):
+        return len(self.user_bets)
+
+    @classmethod
+    def from_rows(cls, rows, colors=COLORS):
+        ledger = cls(colors)
+        for user_id, color, amount in rows:
+            ledger.add(user_id, color, amount)
+        return ledger
+
+
+class MemberCache:
+    """TTL/LRU display-name cache keyed by (guild_id, user_id), filled with chunked ``query_members`` calls."""
+
+    def __init__(self, maxsize=5000, ttl=600.0, chunk_size=100):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.chunk_size = chunk_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, guild_id, user_id):
+        key = (guild_id, user_id)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return False, None
+        self.entries.move_to_end(key)
+        return True, entry[1]
+
+    def put(self, guild_id, user_id, name):
+        key = (guild_id, user_id)
+        self.entries[key] = (time.monotonic() + self.ttl, name)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    async def resolve(self, guild, user_ids):
+        """Return ``{user_id: display_name or None}`` for ``user_ids``."""
+        names, missing = {}, []
+        for user_id in dict.fromkeys(user_ids):
+            found, name = self.get(guild.id, user_id)
+            if found:
+                self.hits += 1
+                names[user_id] = name
+                continue
+            self.misses += 1
+            member = guild.get_member(user_id)
+            if member:
+                names[user_id] = member.display_name
+                self.put(guild.id, user_id, member.display_name)
+            else:
+                missing.append(user_id)
+
+        for i in range(0, len(missing), self.chunk_size):
+            chunk = missing[i:i + self.chunk_size]
+            started = time.perf_counter()
+            try:
+                members = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=True)
+            except (discord.ClientException, asyncio.TimeoutError):
+                members = None  # Unknown this time only; left uncached so the next lookup asks again
+            record_call("gateway.query_members", time.perf_counter() - started)
+            found = {member.id: member.display_name for member in members or ()}
+            for user_id in chunk:
+                names[user_id] = found.get(user_id)
+                if members is not None:
+                    self.put(guild.id, user_id, names[user_id])
+        return names
+
+    async def display_name(self, guild, user_id, default='Unknown User'):
+        return (await self.resolve(guild, [user_id]))[user_id] or default
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
+
+
+class LeaderboardService:
+    """Leaderboard pages and ranks off the ``balance_rank`` index; the first pages are cached until users change."""
+
+    sort = [("balance", DESCENDING), ("_id", ASCENDING)]
+
+    def __init__(self, store, page_size=10, cached_pages=5, ttl=60.0):
+        self.store = store
+        self.page_size = page_size
+        self.cached_pages = cached_pages
+        self.ttl = ttl
+        self.pages = {}
+        self.generation = 0
+        store.users.on_change.append(self.invalidate)
+
+    def invalidate(self):
+        self.generation += 1
+        self.pages.clear()
+
+    async def page(self, number):
+        """Return the user documents on zero-based page ``number``."""
+        cached = self.pages.get(number)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        generation = self.generation
+        users = await self.store.users.find(
+            {}, {"balance": 1}, sort=self.sort, skip=number * self.page_size, limit=self.page_size)
+        if number < self.cached_pages and generation == self.generation:
+            self.pages[number] = (time.monotonic() + self.ttl, users)
+        return users
+
+    async def page_count(self):
+        return -(-await self.store.users.estimated_document_count() // self.page_size)
+
+    async def rank(self, user_id):
+        """Return ``(rank, balance)`` for ``user_id``, or ``None`` if unknown."""
+        user = await self.store.users.find_one({"_id": user_id}, {"balance": 1})
+        if not user:
+            return None
+        balance = user.get("balance", 0)
+        ahead = await self.store.users.count_documents({"balance": {"$gt": balance}})
+        tied_ahead = await self.store.users.count_documents({"balance": balance, "_id": {"$lt": user_id}})
+        return ahead + tied_ahead + 1, balance
+
+
+class ReactionRoute:
+    __slots__ = ("handler", "kind", "timeout", "on_expire", "timer")
+
+    def __init__(self, handler, kind, timeout, on_expire):
+        self.handler = handler
+        self.kind = kind
+        self.timeout = timeout
+        self.on_expire = on_expire
+        self.timer = None
+
+
+class ReactionRouter:
+    """Dispatches raw reaction events to the route registered for their message, with optional expiry."""
+
+    def __init__(self):
+        self.routes = {}
+
+    def register(self, message_id, handler, kind, timeout=None, on_expire=None):
+        self.routes[message_id] = ReactionRoute(handler, kind, timeout, on_expire)
+        self.touch(message_id)
+
+    def unregister(self, message_id):
+        route = self.routes.pop(message_id, None)
+        if route and route.timer:
+            route.timer.cancel()
+        return route
+
+    def touch(self, message_id):
+        route = self.routes.get(message_id)
+        if not route or route.timeout is None:
+            return
+        if route.timer:
+            route.timer.cancel()
+        route.timer = asyncio.get_running_loop().call_later(route.timeout, self._expire, message_id)
+
+    def _expire(self, message_id):
+        route = self.unregister(message_id)
+        if route and route.on_expire:
+            asyncio.create_task(route.on_expire())
+
+    async def dispatch(self, payload):
+        route = self.routes.get(payload.message_id)
+        if route:
+            await route.handler(payload)
+
+    def close(self):
+        for message_id in list(self.routes):
+            self.unregister(message_id)
+
+    def stats(self):
+        return dict(Counter(route.kind for route in self.routes.values()), total=len(self.routes))
+
+
+MESSAGE_LIMIT = 2000  # Discord's maximum characters per message
+
+
+def pack_lines(lines, limit=MESSAGE_LIMIT):
+    """Greedily join ``lines`` into as few messages of at most ``limit`` characters as possible."""
+    messages, current = [], ""
+    for line in lines:
+        while len(line) > limit:  # A single oversized line is hard-split
+            if current:
+                messages.append(current)
+                current = ""
+            messages.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+
+class RateLimitBucket:
+    """Token bucket pacing sends to one channel below Discord's per-channel limit."""
+
+    def __init__(self, rate=5, per=5.0):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.waited = 0.0
+
+    async def acquire(self):
+        async with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                delay = (1 - self.tokens) * self.per / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
+                self._refill()
+            self.tokens -= 1
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+
+class OutputPipeline:
+    """Per-channel, rate-limited sender that packs queued lines into as few messages as possible."""
+
+    def __init__(self, rate=5, per=5.0):
+        self.rate = rate
+        self.per = per
+        self.buckets = {}
+        self.queues = {}
+        self.writers = {}
+        self.messages_sent = 0
+
+    async def send_lines(self, destination, lines):
+        lines = list(lines)
+        if not lines:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(destination.id, []).append((lines, future))
+        if destination.id not in self.writers:
+            self.writers[destination.id] = asyncio.create_task(self._drain(destination))
+        await future
+
+    async def _drain(self, destination):
+        bucket = self.buckets.setdefault(destination.id, RateLimitBucket(self.rate, self.per))
+        queue = self.queues[destination.id]
+        try:
+            while queue:
+                batch = queue[:]
+                del queue[:]
+                try:
+                    for message in pack_lines([line for lines, _ in batch for line in lines]):
+                        await bucket.acquire()
+                        await destination.send(message)
+                        self.messages_sent += 1
+                except Exception as e:
+                    for _, future in batch:
+                        future.set_exception(e)
+                else:
+                    for _, future in batch:
+                        future.set_result(None)
+        finally:
+            del self.writers[destination.id]
+
+
+class Paginator:
+    """Reaction-driven embed pager that renders pages on demand and keeps the last few in an LRU."""
+
+    def __init__(self, render, page_count=None, cache_size=5, timeout=60.0):
+        self.render = render
+        self.page_count = page_count
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self.cache = OrderedDict()
+        self.current_page = 0
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    def from_source(cls, fetch, build, per_page, total=None, **kwargs):
+        """Page over ``fetch(skip, limit)`` and format each slice with ``build(items, number)``."""
+        async def render(number):
+            items = await fetch(number * per_page, per_page)
+            return await build(items, number) if items else None
+
+        return cls(render, page_count=-(-total // per_page) if total is not None else None, **kwargs)
+
+    async def get(self, number):
+        if number in self.cache:
+            self.cache.move_to_end(number)
+            return self.cache[number]
+        embed = await self.render(number)
+        if embed is not None:
+            self.cache[number] = embed
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return embed
+
+    async def start(self, ctx, router, send=None):
+        """Send the first page and register navigation with ``router``; returns immediately."""
+        first = await self.get(0)
+        message = await (send or ctx.send)(embed=first)
+        if self.page_count is not None and self.page_count <= 1:
+            return message
+        await message.add_reaction("⬅️")
+        await message.add_reaction("➡️")
+
+        async def navigate(payload):
+            emoji = str(payload.emoji)
+            if payload.user_id != ctx.author.id or emoji not in ["⬅️", "➡️"]:
+                return
+            router.touch(message.id)
+            async with self.lock:
+                target = self.current_page + (1 if emoji == "➡️" else -1)
+                if target >= 0 and (self.page_count is None or target < self.page_count):
+                    embed = await self.get(target)
+                    if embed is not None:
+                        self.current_page = target
+                        await message.edit(embed=embed)
+            await message.remove_reaction(payload.emoji, payload.member or discord.Object(payload.user_id))
+
+        router.register(message.id, navigate, kind="paginator", timeout=self.timeout,
+                        on_expire=message.clear_reactions)
+        return message
+
+
+class ApprovalQueue:
+    """Withdrawal and redemption requests waiting for an admin's ✅, keyed by the admin message id."""
+
+    def __init__(self, store, ttl=86400.0):
+        self.store = store
+        self.ttl = ttl
+
+    async def pending_ids(self):
+        documents = await self.store.approvals.find({"status": "pending"}, {"_id": 1})
+        return [document["_id"] for document in documents]
+
+    async def submit(self, message_id, **request):
+        now = datetime.datetime.now()
+        await self.store.approvals.insert_one(dict(
+            request, _id=message_id, status="pending", created_at=now,
+            expires_at=now + datetime.timedelta(seconds=self.ttl)))
+
+    async def claim(self, message_id, admin_id):
+        """Atomically mark a pending request approved; ``None`` if someone else got there first."""
+        return await self.store.approvals.find_one_and_update(
+            {"_id": message_id, "status": "pending"},
+            {"$set": {"status": "approved", "approved_by": admin_id, "approved_at": datetime.datetime.now()}})
+
+    async def expire(self):
+        """Mark every overdue request expired and return them."""
+        expired = []
+        overdue = await self.store.approvals.find(
+            {"status": "pending", "expires_at": {"$lte": datetime.datetime.now()}})
+        for document in overdue:
+            document = await self.store.approvals.find_one_and_update(
+                {"_id": document["_id"], "status": "pending"}, {"$set": {"status": "expired"}})
+            if document:
+                expired.append(document)
+        return expired
+
+
+@dataclass
+class BettingRound:
+    """One betting session; ``status`` moves OPEN -> CLOSED -> SETTLING -> SETTLED, each step a compare-and-set."""
+    OPEN, CLOSED, SETTLING, SETTLED = "open", "closed", "settling", "settled"
+    order = (OPEN, CLOSED, SETTLING, SETTLED)
+    transitions = {OPEN: CLOSED, CLOSED: SETTLING, SETTLING: SETTLED}
+
+    channel_id: int
+    guild_id: int
+    id: ObjectId = field(default_factory=ObjectId)
+    opened_at: datetime.datetime = field(default_factory=datetime.datetime.now)
+    closes_at: datetime.datetime = None  # When the timer closes the round; None for manual close only
+    status: str = OPEN
+    ledger: RoundLedger = field(default_factory=RoundLedger)
+    timer: asyncio.Task = field(default=None, repr=False, compare=False)
+    bets_in_flight: int = field(default=0, repr=False, compare=False)
+    rolling: bool = field(default=False, repr=False, compare=False)  # A roll in this process is settling it
+    drained: asyncio.Event = field(default_factory=asyncio.Event, repr=False, compare=False)
+
+    def __post_init__(self):
+        if not self.bets_in_flight:
+            self.drained.set()
+
+    @property
+    def bet_filter(self):
+        return {"session_id": self.id}
+
+    @contextlib.asynccontextmanager
+    async def placing_bet(self):
+        """Mark a bet as in flight; closing waits until every one has finished or backed out."""
+        self.bets_in_flight += 1
+        self.drained.clear()
+        try:
+            yield
+        finally:
+            self.bets_in_flight -= 1
+            if not self.bets_in_flight:
+                self.drained.set()
+
+    async def advance(self, store, target, **fields):
+        """Move to ``target`` if it is the next state; returns False if the round is elsewhere."""
+        if self.transitions.get(self.status) != target:
+            return False
+        now = datetime.datetime.now()
+        update = {"$set": dict(fields, status=target, **{f"{target}_at": now})}
+        if target == self.SETTLED:
+            update["$unset"] = {"active": ""}
+        result = await store.rounds.update_one({"_id": self.id, "status": self.status}, update)
+        if not result.matched_count:
+            # Another process moved it first; catch up so the next step starts from the right state
+            document = await store.rounds.find_one({"_id": self.id}, {"status": 1})
+            if document:
+                self.observe(document["status"])
+            return False
+        self.status = target
+        return True
+
+    def observe(self, status):
+        """Adopt a status set elsewhere; returns False if it isn't ahead of ours."""
+        if self.order.index(status) <= self.order.index(self.status):
+            return False
+        self.status = status
+        if status != self.OPEN:
+            self.cancel_timer()
+        return True
+
+    def cancel_timer(self):
+        if self.timer and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+
+    def to_document(self):
+        document = {"_id": self.id, "channel_id": self.channel_id, "guild_id": self.guild_id,
+                    "opened_at": self.opened_at, "closes_at": self.closes_at, "status": self.status}
+        if self.status != self.SETTLED:
+            document["active"] = True
+        return document
+
+    @classmethod
+    def from_document(cls, document):
+        return cls(channel_id=document["channel_id"], guild_id=document["guild_id"], id=document["_id"],
+                   opened_at=document["opened_at"], closes_at=document.get("closes_at"), status=document["status"])
+
+
+@dataclass
+class SettledBet:
+    user_id: int
+    color: str
+    amount: int
+    hits: int
+    payout: int
+
+
+@dataclass
+class SettlementReport:
+    """Outcome of one round; the roll command only renders this."""
+    results: tuple
+    winners: list = field(default_factory=list)
+    losers: list = field(default_factory=list)
+
+    @property
+    def total_wagered(self):
+        return sum(bet.amount for bet in self.winners) + sum(bet.amount for bet in self.losers)
+
+    @property
+    def total_paid(self):
+        return sum(bet.payout for bet in self.winners)
+
+    @property
+    def total_lost(self):
+        return sum(bet.amount for bet in self.losers)
+
+    def __bool__(self):
+        return bool(self.winners or self.losers)
+
+
+class StatsRollups:
+    """Hourly and daily game statistics maintained with ``$inc``, one document per bucket."""
+
+    granularities = {
+        "hour": lambda when: when.replace(minute=0, second=0, microsecond=0),
+        "day": lambda when: when.replace(hour=0, minute=0, second=0, microsecond=0),
+    }
+
+    def __init__(self, store):
+        self.store = store
+
+    def updates(self, increments, when=None):
+        """Return one upsert per granularity applying ``increments`` to the bucket holding ``when``."""
+        when = when or datetime.datetime.now()
+        updates = []
+        for granularity, truncate in self.granularities.items():
+            start = truncate(when)
+            updates.append(UpdateOne(
+                {"_id": f"{granularity}:{start.isoformat()}"},
+                {"$inc": increments, "$setOnInsert": {"granularity": granularity, "start": start}},
+                upsert=True))
+        return updates
+
+    @staticmethod
+    def round_increments(report):
+        increments = {"rounds": 1, "volume": report.total_wagered, "paid": report.total_paid}
+        for color, hits in Counter(report.results).items():
+            increments[f"hits.{color}"] = hits
+        return increments
+
+    async def summary(self, start, end, granularity="day"):
+        """Sum every ``granularity`` bucket starting in ``[start, end)``."""
+        buckets = await self.store.rollups.find(
+            {"granularity": granularity, "start": {"$gte": start, "$lt": end}})
+        totals = Counter()
+        hits = Counter()
+        for bucket in buckets:
+            for key in ("rounds", "volume", "paid", "given", "lost", "redeemed"):
+                totals[key] += bucket.get(key, 0)
+            hits.update(bucket.get("hits", {}))
+        totals["house_take"] = totals["volume"] - totals["paid"]
+        return totals, hits
+
+
+class ProfitCounters:
+    """Running given/lost/redeemed totals, updated in the same transaction as their log entries."""
+
+    document_id = "profits"
+
+    def __init__(self, store, rollups):
+        self.store = store
+        self.rollups = rollups
+        self.logs = {"given": store.given_coins, "lost": store.lost_bets, "redeemed": store.redeemed_coins}
+
+    async def record(self, kind, documents):
+        rollups = self.store.rollups.collection
+        rollup_updates = self.rollups.updates({kind: sum(document["amount"] for document in documents)})
+
+        def write(session):
+            self.write(kind, documents, session)
+            rollups.bulk_write(rollup_updates, ordered=False, session=session)
+
+        await self.store.transaction(write)
+
+    def write(self, kind, documents, session):
+        """Insert ``documents`` into the ``kind`` log and count them, inside the caller's transaction."""
+        self.logs[kind].collection.insert_many(documents, ordered=False, session=session)
+        self.store.counters.collection.update_one(
+            {"_id": self.document_id}, {"$inc": {kind: sum(document["amount"] for document in documents)}},
+            upsert=True, session=session)
+
+    async def read(self):
+        document = await self.store.counters.find_one({"_id": self.document_id}) or {}
+        return {kind: document.get(kind, 0) for kind in self.logs}
+
+    async def seed(self):
+        """Count the existing logs into the counters once, before anything is recorded; True if it ran now."""
+        counters = self.store.counters.collection
+
+        def seed(session):
+            document = counters.find_one({"_id": self.document_id}, {"seeded": 1}, session=session)
+            if document and document.get("seeded"):
+                return False
+            self._reset(self._totals(session), session)
+            return True
+
+        return await self.store.transaction(seed)
+
+    async def reconcile(self):
+        def reconcile(session):
+            totals = self._totals(session)
+            self._reset(totals, session)
+            return totals
+
+        return await self.store.transaction(reconcile)
+
+    def _totals(self, session):
+        totals = {}
+        for kind, log in self.logs.items():
+            result = list(log.collection.aggregate(
+                [{"$group": {"_id": None, "total": {"$sum": "$amount"}}}], session=session))
+            totals[kind] = result[0]["total"] if result else 0
+        return totals
+
+    def _reset(self, totals, session):
+        self.store.counters.collection.update_one(
+            {"_id": self.document_id}, {"$set": dict(totals, seeded=True)}, upsert=True, session=session)
+
+
+class SettlementEngine:
+    """Pays out a round with one bulk write, in the transaction that marks it SETTLED."""
+
+    def __init__(self, store, profits, rollups, balances):
+        self.store = store
+        self.profits = profits
+        self.rollups = rollups
+        self.balances = balances
+
+    async def aggregate_bets(self, match=None):
+        pipeline = [
+            {"$match": match or {}},
+            {"$group": {"_id": {"user_id": "$user_id", "color": "$color"}, "amount": {"$sum": "$amount"}}},
+        ]
+        rows = await self.store.bets.aggregate(pipeline)
+        return [(row["_id"]["user_id"], row["_id"]["color"], row["amount"]) for row in rows]
+
+    async def load_ledger(self, match=None):
+        return RoundLedger.from_rows(await self.aggregate_bets(match))
+
+    @staticmethod
+    def compute(results, rows):
+        hit_table = Counter(results)
+        report = SettlementReport(results=tuple(results))
+        for user_id, color, amount in rows:
+            hits = hit_table.get(color, 0)
+            bet = SettledBet(user_id, color, amount, hits, amount * (hits + 1) if hits else 0)
+            (report.winners if hits else report.losers).append(bet)
+        return report
+
+    async def commit(self, report, session_id=None, roll=None):
+        """Pay out ``report`` and record the roll; False if round ``session_id`` is no longer settling."""
+        now = datetime.datetime.now()
+        payouts = Counter()
+        for bet in report.winners:
+            payouts[bet.user_id] += bet.payout
+        losses = [{"user_id": bet.user_id, "amount": bet.amount, "date": now} for bet in report.losers]
+        increments = self.rollups.round_increments(report)
+        if losses:
+            increments["lost"] = sum(loss["amount"] for loss in losses)
+        rollup_updates = self.rollups.updates(increments, now)
+        rounds = self.store.rounds.collection
+        roll_history = self.store.roll_history.collection
+        rollups = self.store.rollups.collection
+
+        def record(session):
+            if session_id is not None:
+                # Without transactions this lands before the payouts, so a retry can lose them but never repeat them
+                result = rounds.update_one(
+                    {"_id": session_id, "status": BettingRound.SETTLING},
+                    {"$set": {"status": BettingRound.SETTLED, "settled_at": now}, "$unset": {"active": ""}},
+                    session=session)
+                if not result.matched_count:
+                    return False
+            if roll:
+                roll_history.insert_one(dict(roll), session=session)
+            if losses:
+                self.profits.write("lost", losses, session)
+                self.balances.record([TransactionLedger.entry("loss", bet.user_id, 0, stake=bet.amount,
+                                                              color=bet.color, session_id=session_id)
+                                      for bet in report.losers], session)
+            rollups.bulk_write(rollup_updates, ordered=False, session=session)
+            return True
+
+        return await self.balances.credit_many(payouts, kind="win", also=record, session_id=session_id)
+
+    async def settle(self, results, ledger, session_id=None, roll=None):
+        """Compute and commit a roll; None if round ``session_id`` was settled by someone else."""
+        report = self.compute(results, ledger.rows())
+        if not await self.commit(report, session_id, roll):
+            return None
+        return report
+
+
+class BetRejected(Exception):
+    """Why a bet couldn't be placed or canceled: ``closed``, ``limit``, ``balance``, ``settling`` or ``gone``."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class BettingTable:
+    """One channel's game: its current round, limits, timer duration and bet write buffer."""
+
+    settings = ("bet_limit", "session_bet_limit", "timer_duration")
+
+    def __init__(self, store, channel_id, guild_id, bet_limit=500, session_bet_limit=500, timer_duration=30):
+        self.store = store
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.bet_limit = bet_limit  # Max bet per transaction
+        self.session_bet_limit = session_bet_limit  # Max total bet per user per session
+        self.timer_duration = timer_duration
+        self.current_round = None  # Unsettled BettingRound, holding the ledger of per-user, per-color bets
+        self.lock = asyncio.Lock()
+        self.bet_writes = WriteBuffer(store.bets)
+
+    @property
+    def betting_open(self):
+        return self.current_round is not None and self.current_round.status == BettingRound.OPEN
+
+    def apply_settings(self, document):
+        for name in self.settings:
+            if name in document:
+                setattr(self, name, document[name])
+
+    async def configure(self, **settings):
+        """Change and persist limits or the timer duration, so they survive restarts."""
+        await self.store.tables.update_one(
+            {"_id": self.channel_id}, {"$set": dict(settings, guild_id=self.guild_id)}, upsert=True)
+        self.apply_settings(settings)
+
+    async def open_round(self, duration=None):
+        """Start a round, closing after ``duration`` seconds if given; None if one is still unsettled."""
+        async with self.lock:
+            if self.current_round:
+                return None
+            closes_at = datetime.datetime.now() + datetime.timedelta(seconds=duration) if duration else None
+            betting_round = BettingRound(channel_id=self.channel_id, guild_id=self.guild_id, closes_at=closes_at)
+            try:
+                await self.store.rounds.insert_one(betting_round.to_document())
+            except DuplicateKeyError:  # An unsettled round this process hasn't seen yet
+                return None
+            self.current_round = betting_round
+            return betting_round
+
+    async def place_bet(self, balances, user_id, color, amount):
+        """Debit ``amount`` and record the bet; returns the new balance or raises BetRejected."""
+        betting_round = self.current_round
+        if not self.betting_open:
+            raise BetRejected("closed")
+        if betting_round.ledger.user_total(user_id) + amount > self.session_bet_limit:
+            raise BetRejected("limit")
+
+        # No await since the open check, so the round can't have closed under us; closing waits for this block
+        async with betting_round.placing_bet():
+            # Reserve the amount in the ledger first so concurrent bets can't slip past the session limit
+            betting_round.ledger.add(user_id, color, amount)
+            bet = self.bet_document(betting_round, user_id, color, amount)
+            new_balance = await balances.debit(user_id, amount, kind="bet", session_id=betting_round.id, color=color,
+                                               bet_id=bet["_id"])
+            if new_balance is None:
+                betting_round.ledger.remove(user_id, color, amount)
+                raise BetRejected("balance")
+            await self.bet_writes.add(bet)
+        return new_balance
+
+    @staticmethod
+    def bet_document(betting_round, user_id, color, amount):
+        return {"_id": ObjectId(), "session_id": betting_round.id, "user_id": user_id, "color": color,
+                "amount": amount, "date": datetime.datetime.now()}
+
+    async def restore_bets(self, betting_round):
+        """Re-insert bets whose debit is in the ledger but whose document was lost from the write buffer."""
+        entries = await self.store.ledger.find(
+            {"session_id": betting_round.id, "type": {"$in": ["bet", "refund"]}},
+            {"type": 1, "bet_id": 1, "user_id": 1, "color": 1, "amount": 1, "date": 1})
+        placed = {entry["bet_id"]: entry for entry in entries if entry["type"] == "bet" and entry.get("bet_id")}
+        for entry in entries:
+            if entry["type"] == "refund":
+                placed.pop(entry.get("bet_id"), None)
+        if placed:
+            for bet in await self.store.bets.find({"_id": {"$in": list(placed)}}, {"_id": 1}):
+                del placed[bet["_id"]]
+        if placed:
+            await self.store.bets.insert_many([
+                {"_id": bet_id, "session_id": betting_round.id, "user_id": entry["user_id"], "color": entry["color"],
+                 "amount": -entry["amount"], "date": entry["date"]}
+                for bet_id, entry in placed.items()], ordered=False)
+        return len(placed)
+
+    async def cancel_bet(self, balances, bet):
+        """Delete and refund ``bet`` in one transaction, unless its round is settling or settled."""
+        rounds = self.store.rounds.collection
+        bets = self.store.bets.collection
+
+        def remove(session):
+            document = rounds.find_one({"_id": bet.get("session_id")}, {"status": 1}, session=session)
+            if not document or document["status"] == BettingRound.SETTLED:
+                raise BetRejected("gone")
+            if document["status"] == BettingRound.SETTLING:
+                raise BetRejected("settling")
+            if not bets.delete_one({"_id": bet["_id"]}, session=session).deleted_count:
+                raise BetRejected("gone")
+
+        # Held so a roll can't compute payouts between the delete and the ledger update
+        async with self.lock:
+            betting_round = self.current_round
+            if betting_round and betting_round.status == BettingRound.SETTLING:
+                raise BetRejected("settling")
+            await self.refund(balances, bet, remove)
+            if betting_round and bet.get("session_id") == betting_round.id:
+                betting_round.ledger.remove(bet['user_id'], bet['color'], bet['amount'])
+
+    @staticmethod
+    async def refund(balances, bet, remove):
+        await balances.credit(bet["user_id"], bet["amount"], kind="refund", also=remove,
+                              session_id=bet.get("session_id"), bet_id=bet["_id"])
+
+    async def close_round(self, betting_round):
+        """OPEN -> CLOSED once bets in flight have landed; False if the round was already closed."""
+        async with self.lock:
+            return await self._close_locked(betting_round)
+
+    async def _close_locked(self, betting_round):
+        if not await betting_round.advance(self.store, BettingRound.CLOSED):
+            return False
+        betting_round.cancel_timer()
+        await betting_round.drained.wait()
+        await self.bet_writes.flush()
+        return True
+
+    async def start_settling(self, betting_round, results):
+        """Close ``betting_round`` if still open, then move it to SETTLING; False if it already is."""
+        async with self.lock:
+            if betting_round.status == BettingRound.OPEN:
+                await self._close_locked(betting_round)
+            return await betting_round.advance(self.store, BettingRound.SETTLING, results=list(results))
+
+    async def finish_round(self, betting_round):
+        """After the settlement marked the round SETTLED: drop its bets and free the table for the next round."""
+        await self.store.bets.delete_many(betting_round.bet_filter)
+        async with self.lock:
+            betting_round.observe(BettingRound.SETTLED)
+            if self.current_round is betting_round:
+                self.current_round = None
+
+    async def round_bets(self, filter=None, limit=0):
+        if not self.current_round:
+            return []
+        await self.bet_writes.flush()
+        query = dict(self.current_round.bet_filter, **(filter or {}))
+        return await self.store.bets.find(query, sort=[("date", DESCENDING)], limit=limit)
+
+    async def close(self):
+        if self.current_round:
+            self.current_round.cancel_timer()
+        await self.bet_writes.flush(raise_errors=False)
+
+
+class SharedBettingTable(BettingTable):
+    """A BettingTable whose stakes live on the round document, so several processes can take bets."""
+
+    async def place_bet(self, balances, user_id, color, amount):
+        betting_round = self.current_round
+        if not self.betting_open:
+            raise BetRejected("closed")
+        bet = self.bet_document(betting_round, user_id, color, amount)
+        new_balance = await balances.debit(user_id, amount, kind="bet", session_id=betting_round.id, color=color,
+                                           bet_id=bet["_id"])
+        if new_balance is None:
+            raise BetRejected("balance")
+
+        stake = f"stakes.{user_id}"
+        result = await self.store.rounds.update_one(
+            {"_id": betting_round.id, "status": BettingRound.OPEN,
+             f"{stake}.total": {"$not": {"$gt": self.session_bet_limit - amount}}},
+            {"$inc": {f"{stake}.total": amount, f"{stake}.{color}": amount}})
+        if not result.matched_count:
+            await balances.credit(user_id, amount, kind="refund", session_id=betting_round.id, bet_id=bet["_id"])
+            document = await self.store.rounds.find_one({"_id": betting_round.id}, {"status": 1})
+            if document and document["status"] == BettingRound.OPEN:
+                raise BetRejected("limit")
+            if document:
+                betting_round.observe(document["status"])
+            raise BetRejected("closed")
+        await self.bet_writes.add(bet)
+        return new_balance
+
+    async def cancel_bet(self, balances, bet):
+        rounds = self.store.rounds.collection
+        bets = self.store.bets.collection
+        stake = f"stakes.{bet['user_id']}"
+
+        def remove(session):
+            if not bets.delete_one({"_id": bet["_id"]}, session=session).deleted_count:
+                raise BetRejected("gone")
+            result = rounds.update_one(
+                {"_id": bet.get("session_id"), "status": {"$in": [BettingRound.OPEN, BettingRound.CLOSED]},
+                 f"{stake}.{bet['color']}": {"$gte": bet["amount"]}},
+                {"$inc": {f"{stake}.total": -bet["amount"], f"{stake}.{bet['color']}": -bet["amount"]}},
+                session=session)
+            if not result.matched_count:
+                if session is None:  # No transaction to roll the delete back
+                    bets.insert_one(bet)
+                raise BetRejected("settling")
+
+        await self.refund(balances, bet, remove)
+
+    async def load_ledger(self, betting_round):
+        document = await self.store.rounds.find_one({"_id": betting_round.id}, {"stakes": 1})
+        betting_round.ledger = RoundLedger.from_rows(
+            (int(user_id), color, amount)
+            for user_id, stakes in ((document or {}).get("stakes") or {}).items()
+            for color, amount in stakes.items() if color != "total" and amount)
+
+    async def _close_locked(self, betting_round):
+        if not await super()._close_locked(betting_round):
+            return False
+        await self.load_ledger(betting_round)
+        return True
+
+    async def start_settling(self, betting_round, results):
+        if not await super().start_settling(betting_round, results):
+            return False
+        await self.load_ledger(betting_round)  # Final: stakes can't change once the round is settling
+        return True
+
 
 # Emoji constants
 EMOJI_PESO_COIN = "Replace with own emoji"
@@ -27,9 +1087,31 @@ EMOJI_GREEN = "Replace with own emoji"
 
 
 class ColorGame(commands.Cog):
-    def __init__(self, client):
+    def __init__(self, client, store, shared=False):
         self.client = client
-        self.allowed_channels = ["replace with your channel ID's]
+        self.store = store
+        self.shared = shared  # Several processes serve the same tables; see cog_load
+        self.feeds = []
+        self.rollups = StatsRollups(self.store)
+        self.profits = ProfitCounters(self.store, self.rollups)
+        self.ledger = TransactionLedger(self.store, lag=60.0 if shared else 0.0)
+        self.balances = BalanceService(self.store, ledger=self.ledger)
+        self.settlement = SettlementEngine(self.store, self.profits, self.rollups, self.balances)
+        self.member_cache = MemberCache()
+        self.leaderboard_service = LeaderboardService(self.store)
+        self.approvals = ApprovalQueue(self.store)
+        self.exporter = Exporter(self.store)
+        self.archiver = SeasonArchiver(self.store, self.balances, self.profits)
+        self.archive_task = None
+        self.export_dir = os.getenv('COLORGAME_EXPORT_DIR', 'exports')
+        self.export_upload_limit = 8 * 1024 * 1024  # Larger exports stay in export_dir instead of being attached
+        self.reactions = ReactionRouter()
+        self.output = OutputPipeline()
+        self.metrics = PerfMetrics()
+        self.lag_sampler = None
+        self.admin_channel_id = 1256432375626207283
+        self.load_seconds = None  # Set by setup(): connect, index checks and add_cog, logged on every (re)load
+        self.allowed_channels = ["replace with your channel ID's"]
         self.colors = {
             'red': EMOJI_RED,
             'purple': EMOJI_PURPLE,
@@ -38,13 +1120,27 @@ class ColorGame(commands.Cog):
             'blue': EMOJI_BLUE,
             'green': EMOJI_GREEN
         }
-        self.betting_open = False
-        self.bet_limit = 500  # Max bet per transaction
-        self.session_bet_limit = 500  # Max total bet per user per session
-        self.user_session_bets = {}  # Tracks bets per user per session
-        self.timer_active = False
+        self.tables = {}  # channel id -> BettingTable
+        # Defaults for new tables; the set_* commands change the table of the channel they're used in
+        self.bet_limit = 500
+        self.session_bet_limit = 500
         self.betting_timer_duration = 30
 
+    def table(self, channel_id, guild_id):
+        table = self.tables.get(channel_id)
+        if table is None:
+            table = self.tables[channel_id] = (SharedBettingTable if self.shared else BettingTable)(
+                self.store, channel_id, guild_id, bet_limit=self.bet_limit,
+                session_bet_limit=self.session_bet_limit, timer_duration=self.betting_timer_duration)
+        return table
+
+    def table_for(self, ctx):
+        return self.table(ctx.channel.id, ctx.guild.id)
+
+    def table_for_round(self, session_id):
+        return next((table for table in self.tables.values()
+                     if table.current_round and table.current_round.id == session_id), None)
+
     def in_allowed_channels():
         async def predicate(ctx):
             return ctx.channel.id in ctx.cog.allowed_channels
@@ -57,30 +1153,352 @@ class ColorGame(commands.Cog):
 
         return commands.check(predicate)
 
+    async def cog_load(self):
+        if self.shared:
+            # Other processes open, close and settle rounds and change limits; follow them through change streams
+            if self.store.in_memory:
+                raise RuntimeError("Shared mode needs change streams, which the in-memory backend doesn't have.")
+            self.feeds = [
+                ChangeFeed(self.store.rounds, self.apply_round_change, self.restore_rounds, pipeline=[{"$match": {
+                    "$or": [{"operationType": "insert"}, {"updateDescription.updatedFields.status": {"$exists": True}}]}}]),
+                ChangeFeed(self.store.tables, self.apply_table_change, self.restore_tables, full_document="updateLookup"),
+                ChangeFeed(self.store.users, self.apply_balance_change, self.clear_balance_cache,
+                           pipeline=[{"$project": {"operationType": 1, "documentKey": 1}}]),
+            ]
+            for feed in self.feeds:
+                await feed.open()  # Before loading the state they keep current
+        await self.restore_tables()
+        if await self.ledger.open_books():
+            log.info("Transaction ledger opened from the current balances")
+        if await self.profits.seed():
+            log.info("Profit counters seeded from the given/lost/redeemed logs")
+        for document in await self.store.rounds.find({"status": BettingRound.SETTLING}):
+            await self.resume_settlement(document)
+        await self.restore_rounds()
+        for feed in self.feeds:
+            feed.start()
+        for message_id in await self.approvals.pending_ids():
+            self.reactions.register(message_id, self.handle_approval, kind="approval")
+        self.expire_approvals.start()
+        self.snapshot_ledger.start()
+        self.resume_archives.start()
+        self.lag_sampler = asyncio.create_task(self.metrics.sample_loop_lag())
+
+    async def cog_unload(self):
+        for feed in self.feeds:
+            feed.close()
+        self.expire_approvals.cancel()
+        self.snapshot_ledger.cancel()
+        self.resume_archives.cancel()
+        if self.archive_task:
+            self.archive_task.cancel()  # Another process, or the next load, picks the job up from its cursor
+        for table in self.tables.values():
+            await table.close()
+        if self.lag_sampler:
+            self.lag_sampler.cancel()
+        self.reactions.close()
+        self.store.close()
+
+    async def restore_tables(self):
+        for document in await self.store.tables.find({}):
+            self.table(document["_id"], document["guild_id"]).apply_settings(document)
+
+    async def restore_rounds(self):
+        """Make every table's current round the latest unsettled round of its channel in Mongo."""
+        documents = await self.store.rounds.find(
+            {"status": {"$in": [BettingRound.OPEN, BettingRound.CLOSED]}}, sort=[("opened_at", DESCENDING)])
+        latest = set()
+        for document in documents:
+            table = self.table(document["channel_id"], document["guild_id"])
+            if table.channel_id in latest:
+                log.warning("Round %s is not the latest in channel %s; leaving it unsettled",
+                            document["_id"], table.channel_id)
+                continue
+            latest.add(table.channel_id)
+            await self.adopt_round(table, document)
+        for table in self.tables.values():
+            betting_round = table.current_round
+            # Settled elsewhere while we weren't watching; a round this process is settling stays until it's done
+            if betting_round and table.channel_id not in latest and betting_round.status != BettingRound.SETTLING:
+                betting_round.cancel_timer()
+                table.current_round = None
+
+    async def resume_settlement(self, document):
+        """Finish a round whose roll stopped before paying out, with the colors it rolled."""
+        table = self.table(document["channel_id"], document["guild_id"])
+        await self.adopt_round(table, document)
+        log.warning("Round %s was interrupted while settling; finishing it with %s",
+                    document["_id"], ", ".join(document["results"]))
+        try:
+            report = await self.settle_round(table, table.current_round, document["results"])
+        except Exception:
+            log.exception("Could not finish round %s; rolling again in its channel retries it", document["_id"])
+            return
+        channel = self.client.get_channel(table.channel_id)
+        if report and channel:
+            await self.output.send_lines(channel, [
+                "Finished the interrupted roll: " + " ".join(self.colors[color] for color in report.results)
+            ] + self.settlement_lines(report))
+
+    async def adopt_round(self, table, document):
+        """Make ``document`` the table's current round, or catch up on its status if it already is."""
+        betting_round = table.current_round
+        if betting_round and betting_round.id == document["_id"]:
+            betting_round.observe(document["status"])
+            return
+        if betting_round:
+            betting_round.cancel_timer()
+        betting_round = table.current_round = BettingRound.from_document(document)
+        if self.shared:
+            await table.load_ledger(betting_round)
+        else:
+            restored = await table.restore_bets(betting_round)
+            if restored:
+                log.warning("Restored %d bets of round %s that were lost from the write buffer",
+                            restored, betting_round.id)
+            betting_round.ledger = await self.settlement.load_ledger(betting_round.bet_filter)
+        # Every process that can see the channel counts down; closing is a compare-and-set, so one of them wins
+        if betting_round.status == BettingRound.OPEN and betting_round.closes_at and (
+                not self.shared or self.client.get_channel(table.channel_id)):
+            betting_round.timer = asyncio.create_task(self.run_timer(table, betting_round))
+
+    async def apply_round_change(self, change):
+        if change["operationType"] == "insert":
+            document = change["fullDocument"]
+            if document["status"] in (BettingRound.OPEN, BettingRound.CLOSED):
+                await self.adopt_round(self.table(document["channel_id"], document["guild_id"]), document)
+            return
+        table = self.table_for_round(change["documentKey"]["_id"])
+        if not table:
+            return
+        status = change["updateDescription"]["updatedFields"]["status"]
+        table.current_round.observe(status)
+        if status == BettingRound.SETTLED:
+            table.current_round = None
+
+    async def apply_table_change(self, change):
+        document = change.get("fullDocument")
+        if document:
+            self.table(document["_id"], document["guild_id"]).apply_settings(document)
+
+    async def apply_balance_change(self, change):
+        if "documentKey" in change:  # Not on drop or invalidate events
+            self.balances.cache.evict([change["documentKey"]["_id"]])
+
+    async def clear_balance_cache(self):
+        self.balances.cache.clear()
+
+    async def cog_before_invoke(self, ctx):
+        ctx.invocation = self.metrics.begin()
+
+    async def cog_after_invoke(self, ctx):
+        invocation = getattr(ctx, "invocation", None)
+        if invocation:
+            self.metrics.finish(ctx.command.qualified_name, invocation, failed=ctx.command_failed)
+
+    @tasks.loop(hours=1)
+    async def snapshot_ledger(self):
+        try:
+            folded = await self.ledger.snapshot()
+        except Exception:  # tasks.loop would stop for good; the next run folds these entries too
+            log.exception("Failed to snapshot the transaction ledger; retrying in an hour")
+            return
+        log.info("Folded %d ledger entries into the balance snapshot", folded)
+
+    @tasks.loop(minutes=1)
+    async def resume_archives(self):
+        if self.archive_task and not self.archive_task.done():
+            return
+        try:
+            job = await self.archiver.claim_stale()
+        except Exception:  # tasks.loop would stop for good and stale jobs would never be picked up
+            log.exception("Failed to look for stale archive jobs; retrying in a minute")
+            return
+        if job:
+            log.info("Resuming archive job %s for season %s", job["_id"], job["season"])
+            channel = self.client.get_channel(self.admin_channel_id) if self.client else None
+            message = None
+            if channel:
+                try:
+                    message = await channel.send(embed=self.archive_embed(job, "Resuming Archive"))
+                except discord.HTTPException:
+                    log.exception("Failed to announce resumed archive job %s", job["_id"])
+            self.archive_task = asyncio.create_task(self.run_archive(job, message))
+
+    def archive_embed(self, job, title):
+        lines = []
+        for name in job["sources"]:
+            moved = f"{job['moved'].get(name, 0)}/~{job['totals'].get(name, 0)}"
+            lines.append(f"**{name}:** {'done' if job.get('done', {}).get(name) else moved}")
+        return discord.Embed(title=title, description=f"Season {job['season']}: " + ", ".join(job["parts"])
+                             + "\n" + "\n".join(lines), color=0xffcba4)
+
+    async def run_archive(self, job, message=None):
+        last_edit = time.monotonic()
+
+        async def progress(job):
+            nonlocal last_edit
+            if message and time.monotonic() - last_edit >= 5:
+                last_edit = time.monotonic()
+                await message.edit(embed=self.archive_embed(job, "Archiving"))
+
+        try:
+            await self.archiver.run(job, progress)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Archive job %s failed; it resumes from its cursor", job["_id"])
+            if message:
+                await message.edit(embed=self.archive_embed(job, "Archive Interrupted, Retrying Soon"))
+            return
+        self.leaderboard_service.invalidate()
+        if message:
+            title = f"Season {job['season']} Archived" if job["rollover"] else "Archive Finished"
+            await message.edit(embed=self.archive_embed(job, title))
+
+    async def start_archive(self, ctx, parts, rollover=False):
+        if "balances" in parts and await self.store.rounds.count_documents({"active": {"$exists": True}}):
+            await ctx.reply("Roll or settle every open round before resetting balances.")
+            return
+        job = await self.archiver.start(parts, rollover=rollover, started_by=ctx.author.id)
+        if not job:
+            await ctx.reply("An archive job is already running; see `.season`.")
+            return
+        message = await ctx.send(embed=self.archive_embed(job, "Archiving"))
+        self.archive_task = asyncio.create_task(self.run_archive(job, message))
+
+    @tasks.loop(minutes=5)
+    async def expire_approvals(self):
+        # tasks.loop stops for good on most exceptions, so nothing may escape
+        try:
+            expired = await self.approvals.expire()
+        except Exception:
+            log.exception("Failed to expire approval requests; retrying on the next run")
+            return
+        for request in expired:
+            self.reactions.unregister(request["_id"])
+            admin_channel = self.client.get_channel(request["admin_channel_id"])
+            if not admin_channel:
+                continue
+            try:
+                if request["kind"] == "withdraw":
+                    await admin_channel.send("No one responded to the withdrawal request in time. It has been canceled.")
+                else:
+                    await admin_channel.send(
+                        f"No one responded to the redemption request from {request['display_name']} in time. It has been canceled.")
+            except discord.HTTPException:
+                log.exception("Failed to announce expired approval request %s", request["_id"])
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        if payload.user_id != self.client.user.id:
+            await self.reactions.dispatch(payload)
+
+    async def handle_approval(self, payload):
+        if str(payload.emoji) != '✅':
+            return
+        if not payload.member or not any(role.name == 'admin' for role in payload.member.roles):
+            return
+
+        self.reactions.unregister(payload.message_id)
+        request = await self.approvals.claim(payload.message_id, payload.user_id)
+        if request:
+            await self.process_approval(request)
+
+    async def process_approval(self, request):
+        channel = self.client.get_channel(request["channel_id"])
+        origin = channel.get_partial_message(request["request_message_id"])
+        new_balance = await self.balances.debit(request["user_id"], request["total_cost"], kind="redeem",
+                                                source=request["kind"], approval_id=request["_id"])
+        if request["kind"] == "withdraw":
+            if new_balance is None:
+                await origin.reply(embed=discord.Embed(
+                    description="Withdrawal approved, but your balance is no longer sufficient.", color=0xffcba4))
+                return
+            amount = request["total_cost"]
+            embed = discord.Embed(
+                title="Approved!",
+                description=f"Updated balance for {request['display_name']}: {new_balance + amount} - {amount} = {EMOJI_PESO_COIN}{new_balance} peso coins.",
+                color=0xffcba4)
+            await origin.reply(embed=embed)
+        else:
+            if new_balance is None:
+                await origin.reply(embed=discord.Embed(
+                    description="Redemption approved, but your balance is no longer sufficient.", color=0xffcba4))
+                return
+            embed = discord.Embed(
+                title="Approved!",
+                description=f"{request['amount']} {request['reward_name']} redeemed for {EMOJI_PESO_COIN}{request['total_cost']} peso coins. New balance: {EMOJI_PESO_COIN}{new_balance}.",
+                color=0xffcba4)
+            await origin.reply(embed=embed)
+
+            await self.profits.record("redeemed", [{
+                "user_id": request["user_id"],
+                "amount": request["total_cost"],
+                "date": datetime.datetime.now()
+            }])
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.display_name != after.display_name:
+            self.member_cache.put(after.guild.id, after.id, after.display_name)
+
+    async def run_timer(self, table, betting_round, message=None, ctx=None):
+        """Count down to ``closes_at`` in ``message``, then close and announce the round."""
+        color_emojis = ' '.join(self.colors.values())
+        while True:
+            remaining = (betting_round.closes_at - datetime.datetime.now()).total_seconds()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(5, remaining))
+            if message and remaining > 5:
+                await message.edit(
+                    content=f"**Betting is now OPEN! Place your bets!**\n{color_emojis}\nClosing in: {round(remaining) - 5} seconds")
+        if message:
+            await message.edit(content=f"**Betting is now OPEN! Place your bets!**\n{color_emojis}\nClosed!")
+        if not await table.close_round(betting_round):
+            return
+        if ctx:
+            await self.send_close_summary(ctx, betting_round)
+        else:
+            channel = self.client.get_channel(betting_round.channel_id)
+            if channel:
+                await channel.send("**Betting is now CLOSED.** Rolling soon.")
+
     @commands.command()
     @in_allowed_channels()
     async def cancel_bet(self, ctx, bet_id: str = None):
-        if not self.betting_open and not ctx.author.guild_permissions.manage_guild:
+        table = self.table_for(ctx)
+        if not table.betting_open and not ctx.author.guild_permissions.manage_guild:
             await ctx.reply("Betting is currently closed. Admin privileges required to cancel bets at this time.")
             return
 
         if bet_id and ctx.author.guild_permissions.manage_guild:
-            bet = bets_collection.find_one({"_id": bet_id})
+            for other in self.tables.values():
+                await other.bet_writes.flush()
+            bet = await self.store.bets.find_one({"_id": ObjectId(bet_id) if ObjectId.is_valid(bet_id) else bet_id})
             if not bet:
                 await ctx.reply("No bet found with that ID.")
                 return
-            user = self.client.get_user(bet['user_id'])
-            action_msg = f"Bet of {bet['amount']} coins on {bet['color']} by {user.display_name if user else 'Unknown User'} has been canceled by admin."
+            user_name = await self.member_cache.display_name(ctx.guild, bet['user_id'])
+            action_msg = f"Bet of {bet['amount']} coins on {bet['color']} by {user_name} has been canceled by admin."
         else:
-            user_bets = list(bets_collection.find({"user_id": ctx.author.id}).sort("date", -1))
+            user_bets = await table.round_bets({"user_id": ctx.author.id}, limit=1)
             if not user_bets:
                 await ctx.reply("You do not have any active bets to cancel.")
                 return
             bet = user_bets[0]
             action_msg = f"Your recent bet of {EMOJI_PESO_COIN}{bet['amount']} peso coins on {bet['color']} has been canceled."
 
-        bets_collection.delete_one({"_id": bet["_id"]})
-        users_collection.update_one({"_id": bet['user_id']}, {"$inc": {"balance": bet["amount"]}})
+        table = self.table_for_round(bet.get("session_id")) or table
+        try:
+            await table.cancel_bet(self.balances, bet)
+        except BetRejected as e:
+            if e.reason == "settling":
+                await ctx.reply("This round is being settled; bets can no longer be canceled.")
+            else:
+                await ctx.reply("That bet has already been settled or canceled.")
+            return
         await ctx.send(action_msg)
 
     @commands.command()
@@ -90,39 +1508,54 @@ class ColorGame(commands.Cog):
         if limit < 1:
             await ctx.reply("Bet limit must be at least 1 peso coin.")
             return
-        self.bet_limit = limit
+        await self.table_for(ctx).configure(bet_limit=limit)
         await ctx.reply(f"Betting limit set to {EMOJI_PESO_COIN}{limit} peso coins.")
 
+    @commands.command()
+    @in_allowed_channels()
+    @is_specific_user()
+    async def set_bet_batching(self, ctx, batch_size: int, delay_ms: int = 50):
+        if batch_size < 1 or delay_ms < 1:
+            await ctx.reply("Batch size and delay must be at least 1.")
+            return
+        bet_writes = self.table_for(ctx).bet_writes
+        await bet_writes.flush()
+        bet_writes.max_batch = batch_size
+        bet_writes.max_delay = delay_ms / 1000
+        if batch_size == 1:
+            await ctx.reply("Bet write batching disabled; every bet is written immediately.")
+        else:
+            await ctx.reply(f"Bets will be written in batches of up to {batch_size} or every {delay_ms} ms.")
+
     @commands.command(aliases=['viewbets', 'viewbet'])
     @in_allowed_channels()
     async def view_bets(self, ctx):
-        user_bets = list(bets_collection.find({"user_id": ctx.author.id}).sort("date", -1))
-        if not user_bets:
+        table = self.table_for(ctx)
+        if not table.current_round:
+            await ctx.reply(embed=discord.Embed(description="You have no active bets.", color=0xffcba4))
+            return
+        query = dict(table.current_round.bet_filter, user_id=ctx.author.id)
+        await table.bet_writes.flush()
+        total = await self.store.bets.count_documents(query)
+        if not total:
             await ctx.reply(embed=discord.Embed(description="You have no active bets.", color=0xffcba4))
             return
 
-        embeds = []
-        embed = discord.Embed(title="Active Bets", color=0xffcba4)
-        field_count = 0
-
-        for bet in user_bets:
-            if field_count == 25:
-                embeds.append(embed)
-                embed = discord.Embed(title="Active Bets (cont.)", color=0xffcba4)
-                field_count = 0
+        async def fetch(skip, limit):
+            return await self.store.bets.find(query, sort=[("date", DESCENDING)], skip=skip, limit=limit)
 
-            color_emoji = self.colors.get(bet['color'], "Unknown Color")
-            embed.add_field(
-                name=f"{color_emoji} Bet",
-                value=f"Amount: {bet['amount']} coins\nPlaced on: {bet['date'].strftime('%Y-%m-%d %H:%M:%S')}",
-                inline=False
-            )
-            field_count += 1
-
-        embeds.append(embed)
+        async def build(bets, number):
+            embed = discord.Embed(title="Active Bets" if number == 0 else "Active Bets (cont.)", color=0xffcba4)
+            for bet in bets:
+                color_emoji = self.colors.get(bet['color'], "Unknown Color")
+                embed.add_field(
+                    name=f"{color_emoji} Bet",
+                    value=f"Amount: {bet['amount']} coins\nPlaced on: {bet['date'].strftime('%Y-%m-%d %H:%M:%S')}",
+                    inline=False
+                )
+            return embed
 
-        for emb in embeds:
-            await ctx.reply(embed=emb)
+        await Paginator.from_source(fetch, build, per_page=25, total=total).start(ctx, self.reactions, send=ctx.reply)
 
     @commands.command(aliases=['give'])
     @in_allowed_channels()
@@ -133,7 +1566,7 @@ class ColorGame(commands.Cog):
             await ctx.send(embed=embed)
             return
 
-        users_collection.update_one({"_id": member.id}, {"$inc": {"balance": amount}}, upsert=True)
+        await self.balances.credit(member.id, amount, kind="give", admin_id=ctx.author.id)
         embed = discord.Embed(
             title="Coins Given",
             description=f"Added {EMOJI_PESO_COIN}{amount} peso coins to {member.display_name}'s balance.",
@@ -141,144 +1574,97 @@ class ColorGame(commands.Cog):
         )
         await ctx.send(embed=embed)
 
-        given_coins_collection.insert_one({
+        await self.profits.record("given", [{
             "user_id": member.id,
             "amount": amount,
             "date": datetime.datetime.now()
-        })
+        }])
 
     @commands.command(aliases=['open'])
     @commands.has_role('admin')
     @in_allowed_channels()
     @is_specific_user()
     async def open_bets(self, ctx):
-        if self.betting_open:
-            await ctx.send("Betting is already open.")
+        table = self.table_for(ctx)
+        betting_round = await table.open_round(table.timer_duration)
+        if not betting_round:
+            await ctx.send("Betting is already open." if table.betting_open else "The last round hasn't been rolled yet.")
             return
 
-        self.betting_open = True
-        self.user_session_bets = {}
-        self.timer_active = True
         color_emojis = ' '.join(self.colors.values())
         message = await ctx.send(
-            f"**Betting is now OPEN! Place your bets!**\n{color_emojis}\nClosing in: {self.betting_timer_duration} seconds")
-
-        for remaining in range(self.betting_timer_duration, 0, -5):
-            await asyncio.sleep(5)
-            if not self.timer_active:
-                break
-            await message.edit(
-                content=f"**Betting is now OPEN! Place your bets!**\n{color_emojis}\nClosing in: {remaining - 5} seconds")
-            if remaining <= 5:
-                await message.edit(content=f"**Betting is now OPEN! Place your bets!**\n{color_emojis}\nClosed!")
-                break
-
-        if self.timer_active:
-            await self.close_bets(ctx)
+            f"**Betting is now OPEN! Place your bets!**\n{color_emojis}\nClosing in: {table.timer_duration} seconds")
+        betting_round.timer = asyncio.create_task(self.run_timer(table, betting_round, message, ctx))
 
     @commands.command(aliases=['close'])
     @commands.has_role('admin')
     @in_allowed_channels()
     async def close_bets(self, ctx):
-        if not self.betting_open:
+        table = self.table_for(ctx)
+        betting_round = table.current_round
+        if not betting_round or not await table.close_round(betting_round):
             await ctx.reply("Betting is already closed.")
             return
+        await self.send_close_summary(ctx, betting_round)
 
-        self.betting_open = False
-        self.timer_active = False
-
-        all_bets = list(bets_collection.find().sort("date", -1))
-        if not all_bets:
+    async def send_close_summary(self, ctx, betting_round):
+        ledger = betting_round.ledger
+        if not ledger:
             await ctx.reply(embed=discord.Embed(description="No bets were placed.", color=0xffcba4))
             return
 
-        aggregated_bets = {}
-        for bet in all_bets:
-            key = (bet['user_id'], bet['color'])
-            aggregated_bets[key] = aggregated_bets.get(key, 0) + bet['amount']
-
-        pages = []
-        page = discord.Embed(title="⚠ ALL BETS ARE NOW CLOSED ⚠ Rolling Soon.", description="**Active Bets:**",
-                             color=0xffcba4)
-        field_count = 0
-        for (user_id, color), total_amount in aggregated_bets.items():
-            user = await ctx.guild.fetch_member(user_id)
-            user_name = user.display_name if user else 'Unknown User'
-            user_info = f"{user_name} (*{user_id}*)" if user else "Unknown User (*Unknown ID*)"
-            color_emoji = self.colors[color] if color in self.colors else "Unknown Color"
-            page.add_field(name=user_info, value=f"{total_amount} on {color_emoji}", inline=False)
-            field_count += 1
-
-            if field_count == 25:
-                pages.append(page)
-                page = discord.Embed(title="Active Bets (cont.)", color=0xffcba4)
-                field_count = 0
-
-        if field_count > 0:
-            pages.append(page)
-
-        message = await ctx.send(embed=pages[0])
-        if len(pages) > 1:
-            await message.add_reaction("⬅️")
-            await message.add_reaction("➡️")
-
-        current_page = 0
+        rows = list(ledger.rows())
 
-        def check(reaction, user):
-            return user == ctx.author and str(reaction.emoji) in ["⬅️", "➡️"] and reaction.message.id == message.id
+        async def fetch(skip, limit):
+            return rows[skip:skip + limit]
 
-        while True:
-            try:
-                reaction, user = await ctx.bot.wait_for('reaction_add', timeout=60.0, check=check)
-                if str(reaction.emoji) == "➡️" and current_page < len(pages) - 1:
-                    current_page += 1
-                    await message.edit(embed=pages[current_page])
-                elif str(reaction.emoji) == "⬅️" and current_page > 0:
-                    current_page -= 1
-                    await message.edit(embed=pages[current_page])
-                await message.remove_reaction(reaction, user)
-            except asyncio.TimeoutError:
-                break
+        async def build(page_rows, number):
+            if number == 0:
+                page = discord.Embed(title="⚠ ALL BETS ARE NOW CLOSED ⚠ Rolling Soon.", description="**Active Bets:**",
+                                     color=0xffcba4)
+            else:
+                page = discord.Embed(title="Active Bets (cont.)", color=0xffcba4)
+            names = await self.member_cache.resolve(ctx.guild, [user_id for user_id, _, _ in page_rows])
+            for user_id, color, total_amount in page_rows:
+                user_name = names[user_id]
+                user_info = f"{user_name} (*{user_id}*)" if user_name else "Unknown User (*Unknown ID*)"
+                color_emoji = self.colors[color] if color in self.colors else "Unknown Color"
+                page.add_field(name=user_info, value=f"{total_amount} on {color_emoji}", inline=False)
+            return page
 
-        await message.clear_reactions()
+        await Paginator.from_source(fetch, build, per_page=25, total=len(rows)).start(ctx, self.reactions)
 
     @commands.command(aliases=['bet'])
     @in_allowed_channels()
     async def start_bet(self, ctx, amount: int = None, color: str = None):
-        if not self.betting_open:
+        table = self.table_for(ctx)
+        if not table.betting_open:
             await ctx.reply(embed=discord.Embed(description="Betting is currently closed.", color=0xffcba4))
             return
-        if amount is None or amount <= 0 or amount > self.bet_limit:
+        if amount is None or amount <= 0 or amount > table.bet_limit:
             await ctx.reply(embed=discord.Embed(
-                description=f"Invalid amount. Bet amount should be between {EMOJI_PESO_COIN}5 and {EMOJI_PESO_COIN}{self.bet_limit} peso coins.",
+                description=f"Invalid amount. Bet amount should be between {EMOJI_PESO_COIN}5 and {EMOJI_PESO_COIN}{table.bet_limit} peso coins.",
                 color=0xffcba4))
             return
         if color.lower() not in self.colors:
             await ctx.reply("Specify a valid color: red, purple, pink, orange, blue, green.")
             return
 
-        user_total_bets = self.user_session_bets.get(ctx.author.id, 0) + amount
-        if user_total_bets > self.session_bet_limit:
-            await ctx.reply(
-                f"Total betting limit per session is {EMOJI_PESO_COIN}{self.session_bet_limit}. Your total bets exceed this limit.")
-            return
-
-        new_balance = users_collection.find_one_and_update(
-            {"_id": ctx.author.id, "balance": {"$gte": amount}},
-            {"$inc": {"balance": -amount}},
-            return_document=True
-        )
-        if not new_balance:
-            await ctx.reply(embed=discord.Embed(description="Insufficient balance.", color=0xffcba4))
+        try:
+            new_balance = await table.place_bet(self.balances, ctx.author.id, color.lower(), amount)
+        except BetRejected as e:
+            if e.reason == "limit":
+                await ctx.reply(
+                    f"Total betting limit per session is {EMOJI_PESO_COIN}{table.session_bet_limit}. Your total bets exceed this limit.")
+            elif e.reason == "balance":
+                await ctx.reply(embed=discord.Embed(description="Insufficient balance.", color=0xffcba4))
+            else:
+                await ctx.reply(embed=discord.Embed(description="Betting is currently closed.", color=0xffcba4))
             return
-
-        self.user_session_bets[ctx.author.id] = user_total_bets
-        bets_collection.insert_one(
-            {"user_id": ctx.author.id, "color": color.lower(), "amount": amount, "date": datetime.datetime.now()})
         embed = discord.Embed(title="Bet Placed",
                               description=f"{ctx.author.display_name} bets {EMOJI_PESO_COIN}`{amount}` peso coins on **{self.colors[color.lower()]}**.",
                               color=0xffcba4)
-        embed.set_footer(text=f"New Balance: {new_balance['balance']} peso coins")
+        embed.set_footer(text=f"New Balance: {new_balance} peso coins")
         await ctx.reply(embed=embed)
 
     @start_bet.error
@@ -294,102 +1680,99 @@ class ColorGame(commands.Cog):
             await ctx.send("Invalid results. Enter three colors from red, purple, pink, orange, blue, green.")
             return
 
-        emoji_message = " ".join([self.colors[color] for color in results])
-        await ctx.send(emoji_message)
+        table = self.table_for(ctx)
+        betting_round = table.current_round
+        if betting_round and betting_round.rolling:
+            await ctx.reply("This round is already being rolled.")
+            return
+        if betting_round:
+            betting_round.rolling = True  # So a second roll meanwhile doesn't take this one for a failed one
+        try:
+            if betting_round and betting_round.status == BettingRound.SETTLING:
+                # An earlier roll failed before paying out; finish it with the colors it rolled
+                document = await self.store.rounds.find_one({"_id": betting_round.id}, {"results": 1})
+                results = tuple(document["results"])
+                await ctx.reply("Finishing the interrupted roll of this round.")
+            elif betting_round and not await table.start_settling(betting_round, results):
+                await ctx.reply("This round is already being rolled.")
+                return
 
-        roll_entry = {
-            "results": results,
-            "date": datetime.datetime.now()
-        }
-        roll_history_collection.insert_one(roll_entry)
+            emoji_message = " ".join([self.colors[color] for color in results])
+            await ctx.send(emoji_message)
 
-        all_bets = list(bets_collection.find())
-        if not all_bets:
+            report = await self.settle_round(table, betting_round, results)
+        finally:
+            if betting_round:
+                betting_round.rolling = False
+        if report is None:
+            return  # Another roll of this round got there first and has announced it
+        if not report:
             await ctx.send("No bets to roll.")
             return
 
-        aggregated_bets = {}
-        for bet in all_bets:
-            user_id = bet['user_id']
-            color = bet['color'].lower()
-            amount = bet['amount']
-            if (user_id, color) not in aggregated_bets:
-                aggregated_bets[(user_id, color)] = 0
-            aggregated_bets[(user_id, color)] += amount
-
-        results_messages = []
-        for (user_id, color), total_amount in aggregated_bets.items():
-            color_hits = sum(1 for result in results if result == color)
-            user = await ctx.guild.fetch_member(user_id)
-            user_mention = user.mention if user else "User not found"
-            multiplier = color_hits + 1 if color_hits > 0 else 0
-            payout = total_amount * multiplier
-
-            if color_hits > 0:
-                results_messages.append(
-                    f"{user_mention} wins {EMOJI_PESO_COIN}{payout} for {color_hits} hits on {self.colors[color]}")
-                users_collection.update_one({"_id": user_id}, {"$inc": {"balance": payout}})
-            else:
-                results_messages.append(
-                    f"{user_mention} loses {EMOJI_PESO_COIN}{total_amount} on {self.colors[color]}")
-                lost_bets_collection.insert_one({
-                    "user_id": user_id,
-                    "amount": total_amount,
-                    "date": datetime.datetime.now()
-                })
-
-        if results_messages:
-            for i in range(0, len(results_messages), 25):
-                await ctx.send("\n".join(results_messages[i:i + 25]))
-        else:
-            await ctx.send("No results to process this time.")
+        await self.output.send_lines(ctx.channel, self.settlement_lines(report))
+
+    def settlement_lines(self, report):
+        return [
+            f"<@{bet.user_id}> wins {EMOJI_PESO_COIN}{bet.payout} for {bet.hits} hits on {self.colors[bet.color]}"
+            for bet in report.winners
+        ] + [
+            f"<@{bet.user_id}> loses {EMOJI_PESO_COIN}{bet.amount} on {self.colors[bet.color]}"
+            for bet in report.losers
+        ]
 
-        bets_collection.delete_many({})
+    async def settle_round(self, table, betting_round, results):
+        """Pay out ``results`` and free the table; None if the round was already settled."""
+        roll_entry = {
+            "results": list(results),
+            "channel_id": table.channel_id,
+            "date": datetime.datetime.now()
+        }
+        if not betting_round:
+            return await self.settlement.settle(results, RoundLedger(), roll=roll_entry)
+        roll_entry["session_id"] = betting_round.id
+        report = await self.settlement.settle(results, betting_round.ledger, session_id=betting_round.id,
+                                              roll=roll_entry)
+        await table.finish_round(betting_round)
+        return report
 
     @commands.command()
     @in_allowed_channels()
     async def leaderboard(self, ctx):
-        top_users = list(users_collection.find().sort("balance", -1))
-        if not top_users:
+        service = self.leaderboard_service
+        page_count = await service.page_count()
+        if not page_count:
             await ctx.reply("Leaderboard is empty.")
             return
 
-        def get_embed_for_users(users, start_index):
+        async def render(number):
+            users = await service.page(number)
+            if not users:
+                return None
+            names = await self.member_cache.resolve(ctx.guild, [user["_id"] for user in users])
             embed = discord.Embed(title=f"{EMOJI_PESO_COIN}peso Coins Leaderboard{EMOJI_PESO_COIN}",
                                   color=0xffcba4)
-            for index, user in enumerate(users, start=start_index):
-                member = ctx.guild.get_member(user["_id"])
-                name = member.display_name if member else 'Unknown User'
+            for index, user in enumerate(users, start=number * service.page_size + 1):
+                name = names[user["_id"]] or 'Unknown User'
                 embed.add_field(name=f"{index}. {name}", value=f"{user['balance']} coins", inline=False)
             return embed
 
-        chunks = [top_users[i:i + 10] for i in range(0, len(top_users), 10)]
-        pages = [get_embed_for_users(chunk, i * 10 + 1) for i, chunk in enumerate(chunks)]
+        await Paginator(render, page_count=page_count).start(ctx, self.reactions, send=ctx.reply)
 
-        message = await ctx.reply(embed=pages[0])
-        await message.add_reaction('⬅️')
-        await message.add_reaction('➡️')
-
-        def check(reaction, user):
-            return user == ctx.author and str(reaction.emoji) in ['⬅️', '➡️'] and reaction.message.id == message.id
-
-        current_page = 0
-        while True:
-            try:
-                reaction, user = await self.client.wait_for('reaction_add', timeout=60.0, check=check)
-                if str(reaction.emoji) == '➡️' and current_page < len(pages) - 1:
-                    current_page += 1
-                    await message.edit(embed=pages[current_page])
-                    await message.remove_reaction(reaction, user)
-                elif str(reaction.emoji) == '⬅️' and current_page > 0:
-                    current_page -= 1
-                    await message.edit(embed=pages[current_page])
-                    await message.remove_reaction(reaction, user)
-                else:
-                    await message.remove_reaction(reaction, user)
-            except asyncio.TimeoutError:
-                await message.clear_reactions()
-                break
+    @commands.command()
+    @in_allowed_channels()
+    async def rank(self, ctx, member: discord.Member = None):
+        member = member or ctx.author
+        result = await self.leaderboard_service.rank(member.id)
+        if not result:
+            await ctx.reply(embed=discord.Embed(description=f"{member.display_name} is not on the leaderboard yet.",
+                                                color=0xffcba4))
+            return
+        position, balance = result
+        embed = discord.Embed(title=f"{member.display_name}'s Rank",
+                              description=f"#{position} with {EMOJI_PESO_COIN}{balance} peso coins",
+                              color=0xffcba4)
+        await ctx.reply(embed=embed)
 
     @commands.command(aliases=['withdraw'])
     @in_allowed_channels()
@@ -399,8 +1782,7 @@ class ColorGame(commands.Cog):
             await ctx.send(embed=embed)
             return
 
-        user_data = users_collection.find_one({"_id": ctx.author.id})
-        if not user_data or user_data['balance'] < amount:
+        if await self.balances.get(ctx.author.id) < amount:
             embed = discord.Embed(description="Insufficient balance to make this withdrawal.", color=0xffcba4)
             await ctx.send(embed=embed)
             return
@@ -408,27 +1790,16 @@ class ColorGame(commands.Cog):
         embed = discord.Embed(description="Waiting approval from admins", color=0xffcba4)
         await ctx.reply(embed=embed)
 
-        admin_channel = self.client.get_channel(1256432375626207283)
+        admin_channel = self.client.get_channel(self.admin_channel_id)
         message = await admin_channel.send(
             f"Withdrawal request from {ctx.author.display_name} for {EMOJI_PESO_COIN}{amount} peso coins. React with ✅ to approve.")
+        await self.approvals.submit(
+            message.id, kind="withdraw", user_id=ctx.author.id, display_name=ctx.author.display_name,
+            total_cost=amount, channel_id=ctx.channel.id, request_message_id=ctx.message.id,
+            admin_channel_id=admin_channel.id)
+        self.reactions.register(message.id, self.handle_approval, kind="approval")
         await message.add_reaction('✅')
 
-        def check(reaction, user):
-            return user != self.client.user and str(reaction.emoji) == '✅' and any(
-                role.name == 'admin' for role in user.roles)
-
-        try:
-            reaction, user = await self.client.wait_for('reaction_add', timeout=86400.0, check=check)
-            new_balance = user_data['balance'] - amount
-            users_collection.update_one({"_id": ctx.author.id}, {"$set": {"balance": new_balance}})
-            embed = discord.Embed(
-                title="Approved!",
-                description=f"Updated balance for {ctx.author.display_name}: {user_data['balance']} - {amount} = {EMOJI_PESO_COIN}{new_balance} peso coins.",
-                color=0xffcba4)
-            await ctx.reply(embed=embed)
-        except asyncio.TimeoutError:
-            await admin_channel.send("No one responded to the withdrawal request in time. It has been canceled.")
-
     @commands.command()
     @in_allowed_channels()
     @is_specific_user()
@@ -438,22 +1809,15 @@ class ColorGame(commands.Cog):
             await ctx.send(embed=embed)
             return
 
-        user_data = users_collection.find_one({"_id": member.id})
-        if not user_data:
-            users_collection.insert_one({"_id": member.id, "balance": 0})
-            current_balance = 0
-        else:
-            current_balance = user_data['balance']
-
-        new_balance = current_balance + adjustment
-        if new_balance < 0:
+        new_balance = await self.balances.adjust(member.id, adjustment, admin_id=ctx.author.id)
+        if new_balance is None:
+            current_balance = await self.balances.get(member.id)
             embed = discord.Embed(
                 description=f"Adjustment failed. The balance cannot go negative. {member.display_name}'s current balance is {EMOJI_PESO_COIN}{current_balance} peso coins.",
                 color=0xffcba4)
             await ctx.send(embed=embed)
             return
 
-        users_collection.update_one({"_id": member.id}, {"$set": {"balance": new_balance}})
         embed = discord.Embed(title="Balance Adjustment",
                               description=f"{member.display_name}'s balance adjusted by {adjustment} peso coins. New balance: {EMOJI_PESO_COIN}{new_balance} peso coins.",
                               color=0xffcba4)
@@ -471,23 +1835,20 @@ class ColorGame(commands.Cog):
             await ctx.send("No members specified.")
             return
 
-        bulk_operations = [
-            UpdateOne({"_id": member.id}, {"$inc": {"balance": amount}}, upsert=True)
-            for member in members
-        ]
+        amounts = Counter()
+        for member in members:
+            amounts[member.id] += amount
 
         try:
-            if bulk_operations:
-                loop = asyncio.get_running_loop()
-                await loop.run_in_executor(None, lambda: users_collection.bulk_write(bulk_operations))
-                result_message = "\n".join(
-                    [f"{member.mention} has received {EMOJI_PESO_COIN}{amount} peso coins." for member in members])
-                await ctx.send(f"Updated balances for {len(members)} members:\n{result_message}")
-
-                await loop.run_in_executor(None, lambda: given_coins_collection.insert_many([
+            if amounts:
+                await self.balances.credit_many(amounts, kind="give", admin_id=ctx.author.id)
+                await self.profits.record("given", [
                     {"user_id": member.id, "amount": amount, "date": datetime.datetime.now()}
                     for member in members
-                ]))
+                ])
+
+                await self.output.send_lines(ctx.channel, [f"Updated balances for {len(members)} members:"] + [
+                    f"{member.mention} has received {EMOJI_PESO_COIN}{amount} peso coins." for member in members])
 
         except Exception as e:
             await ctx.send(f"Failed to update balances due to an error: {e}")
@@ -501,26 +1862,16 @@ class ColorGame(commands.Cog):
             return
 
         try:
-            user_data = users_collection.find_one({"_id": ctx.author.id})
-            if not user_data or user_data.get('balance', 0) < amount:
+            new_giver_balance = await self.balances.transfer(ctx.author.id, recipient.id, amount)
+            if new_giver_balance is None:
                 await ctx.send(embed=discord.Embed(description="Insufficient balance to gift this amount of coins.",
                                                    color=0xffcba4))
                 return
 
-            new_giver_balance = user_data['balance'] - amount
-            users_collection.update_one({"_id": ctx.author.id}, {"$set": {"balance": new_giver_balance}})
-
-            recipient_data = users_collection.find_one({"_id": recipient.id})
-            if not recipient_data:
-                users_collection.insert_one({"_id": recipient.id, "balance": amount})
-            else:
-                new_recipient_balance = recipient_data['balance'] + amount
-                users_collection.update_one({"_id": recipient.id}, {"$set": {"balance": new_recipient_balance}})
-
             embed = discord.Embed(
                 description=f"You have gifted {EMOJI_PESO_COIN}`{amount}` peso coins to {recipient.display_name}.",
                 color=0xffcba4)
-            embed.set_footer(text=f"New Balance: {user_data['balance']} - {amount} = {new_giver_balance}")
+            embed.set_footer(text=f"New Balance: {new_giver_balance + amount} - {amount} = {new_giver_balance}")
             await ctx.reply(embed=embed)
 
         except Exception as e:
@@ -533,13 +1884,7 @@ class ColorGame(commands.Cog):
     async def balance(self, ctx, member: discord.Member = None):
         member = member or ctx.author
         try:
-            user_data = users_collection.find_one({"_id": member.id})
-            if not user_data:
-                users_collection.insert_one({"_id": member.id, "balance": 0})
-                balance = 0
-            else:
-                balance = user_data['balance']
-
+            balance = await self.balances.get(member.id)
             embed = discord.Embed(title=f"{member.display_name}'s Balance",
                                   description=f"{EMOJI_PESO_COIN}{balance} peso coins",
                                   color=0xffcba4)
@@ -551,15 +1896,17 @@ class ColorGame(commands.Cog):
     @commands.command()
     @in_allowed_channels()
     async def history(self, ctx):
-        history_entries = list(roll_history_collection.find().sort("date", -1))
-        if not history_entries:
+        total = await self.store.roll_history.estimated_document_count()
+        if not total:
             await ctx.send(embed=discord.Embed(description="No roll history available.", color=0xffcba4))
             return
 
-        pages = []
-        for i in range(0, len(history_entries), 10):
+        async def fetch(skip, limit):
+            return await self.store.roll_history.find(sort=[("date", DESCENDING)], skip=skip, limit=limit)
+
+        async def build(entries, number):
             embed = discord.Embed(title="Roll History", color=0xffcba4)
-            for entry in history_entries[i:i + 10]:
+            for entry in entries:
                 date_str = entry['date'].strftime('%Y-%m-%d %H:%M:%S')
                 results_emojis = [self.colors[color] for color in entry['results']]
                 results_str = ", ".join(results_emojis)
@@ -568,41 +1915,110 @@ class ColorGame(commands.Cog):
                     value=f"Colors: {results_str}",
                     inline=False
                 )
-            pages.append(embed)
+            return embed
 
-        message = await ctx.send(embed=pages[0])
-        if len(pages) > 1:
-            await message.add_reaction("⬅️")
-            await message.add_reaction("➡️")
+        await Paginator.from_source(fetch, build, per_page=10, total=total).start(ctx, self.reactions)
 
-        current_page = 0
+    @commands.command(aliases=['hot'])
+    @in_allowed_channels()
+    async def hot_colors(self, ctx, hours: int = 24):
+        if hours < 1:
+            await ctx.reply("Specify at least 1 hour.")
+            return
+        end = datetime.datetime.now()
+        start = StatsRollups.granularities["hour"](end - datetime.timedelta(hours=hours - 1))
+        totals, hits = await self.rollups.summary(start, end, granularity="hour")
+        if not totals["rounds"]:
+            await ctx.reply(embed=discord.Embed(description=f"No rolls in the last {hours} hours.", color=0xffcba4))
+            return
 
-        def check(reaction, user):
-            return user == ctx.author and str(reaction.emoji) in ["⬅️", "➡️"] and reaction.message.id == message.id
+        lines = [
+            f"{self.colors[color]} **{hits.get(color, 0)}** hits ({hits.get(color, 0) / totals['rounds']:.2f} per roll)"
+            for color in sorted(self.colors, key=lambda color: -hits.get(color, 0))
+        ]
+        embed = discord.Embed(title=f"Hot Colors (last {hours}h, {totals['rounds']} rolls)", description="\n".join(lines),
+                              color=0xffcba4)
+        await ctx.reply(embed=embed)
 
-        while True:
-            try:
-                reaction, user = await self.client.wait_for('reaction_add', timeout=60.0, check=check)
-                if str(reaction.emoji) == "➡️" and current_page < len(pages) - 1:
-                    current_page += 1
-                    await message.edit(embed=pages[current_page])
-                    await message.remove_reaction(reaction, user)
-                elif str(reaction.emoji) == "⬅️" and current_page > 0:
-                    current_page -= 1
-                    await message.edit(embed=pages[current_page])
-                    await message.remove_reaction(reaction, user)
-                else:
-                    await message.remove_reaction(reaction, user)
-            except asyncio.TimeoutError:
-                await message.clear_reactions()
-                break
+    @commands.command()
+    @in_allowed_channels()
+    @is_specific_user()
+    async def stats(self, ctx, start: str, end: str = None):
+        try:
+            start_date = datetime.datetime.strptime(start, '%Y-%m-%d')
+            end_date = datetime.datetime.strptime(end, '%Y-%m-%d') if end else datetime.datetime.now()
+        except ValueError:
+            await ctx.reply("Dates must be in YYYY-MM-DD format.")
+            return
+        end_date = StatsRollups.granularities["day"](end_date) + datetime.timedelta(days=1)
+        totals, hits = await self.rollups.summary(start_date, end_date)
+
+        hit_str = " ".join(f"{self.colors[color]}{hits.get(color, 0)}" for color in self.colors)
+        embed = discord.Embed(
+            title=f"Stats {start_date:%Y-%m-%d} to {end_date - datetime.timedelta(days=1):%Y-%m-%d}",
+            description=(
+                f"**Rounds:** {totals['rounds']}\n"
+                f"**Volume:** {EMOJI_PESO_COIN}{totals['volume']} peso coins\n"
+                f"**House Take:** {EMOJI_PESO_COIN}{totals['house_take']} peso coins\n"
+                f"**Given:** {EMOJI_PESO_COIN}{totals['given']} peso coins\n"
+                f"**Redeemed:** {EMOJI_PESO_COIN}{totals['redeemed']} peso coins\n"
+                f"**Color Hits:** {hit_str}"
+            ),
+            color=0xffcba4
+        )
+        await ctx.reply(embed=embed)
+
+    @commands.command()
+    @in_allowed_channels()
+    @is_specific_user()
+    async def export(self, ctx, source: str, start: str = None, end: str = None, fmt: str = "jsonl",
+                     after: str = None):
+        if source not in Exporter.sources or fmt not in Exporter.formats:
+            await ctx.reply(f"Usage: `.export <{'|'.join(Exporter.sources)}> [start|-] [end|-] "
+                            f"[{'|'.join(Exporter.formats)}] [after_id]`")
+            return
+        try:
+            start_date = datetime.datetime.strptime(start, '%Y-%m-%d') if start and start != '-' else None
+            end_date = datetime.datetime.strptime(end, '%Y-%m-%d') + datetime.timedelta(days=1) \
+                if end and end != '-' else None
+        except ValueError:
+            await ctx.reply("Dates must be in YYYY-MM-DD format, or - for no bound.")
+            return
+
+        os.makedirs(self.export_dir, exist_ok=True)
+        path = os.path.join(self.export_dir, f"{source}-{datetime.datetime.now():%Y%m%d-%H%M%S}.{fmt}.gz")
+        message = await ctx.reply(embed=discord.Embed(description=f"Exporting {source}...", color=0xffcba4))
+        last_edit = time.monotonic()
+
+        async def progress(count, last_id):
+            nonlocal last_edit
+            if time.monotonic() - last_edit >= 5:
+                last_edit = time.monotonic()
+                await message.edit(embed=discord.Embed(
+                    description=f"Exporting {source}: {count} rows so far (last id `{last_id}`).", color=0xffcba4))
+
+        try:
+            count, last_id = await self.exporter.export(source, path, fmt, start_date, end_date, after, progress)
+        except Exception:
+            log.exception("Export of %s failed", source)
+            await message.edit(embed=discord.Embed(
+                description=f"Export of {source} failed; rows up to the last reported id are in `{path}`.",
+                color=0xffcba4))
+            return
+        embed = discord.Embed(title="Export Finished", description=(
+            f"{count} {source} rows exported to `{path}`." + (f" Last id: `{last_id}`." if last_id else "")),
+            color=0xffcba4)
+        if count and os.path.getsize(path) <= self.export_upload_limit:
+            await ctx.reply(embed=embed, file=discord.File(path))
+        else:
+            await ctx.reply(embed=embed)
+        await message.delete()
 
     @commands.command()
     @in_allowed_channels()
     @is_specific_user()
     async def reset_history(self, ctx):
-        roll_history_collection.delete_many({})
-        await ctx.send(embed=discord.Embed(description="Roll history has been reset.", color=0xffcba4))
+        await self.start_archive(ctx, ["history"])
 
     @commands.command()
     @in_allowed_channels()
@@ -611,7 +2027,7 @@ class ColorGame(commands.Cog):
         if duration < 1:
             await ctx.reply("Betting timer duration must be at least 1 second.")
             return
-        self.betting_timer_duration = duration
+        await self.table_for(ctx).configure(timer_duration=duration)
         await ctx.reply(f"Betting timer duration set to {duration} seconds.")
 
     @commands.command(aliases=['redeem'])
@@ -646,8 +2062,7 @@ class ColorGame(commands.Cog):
         reward = rewards[reward_type.lower()]
         total_cost = reward['cost'] * amount
 
-        user_data = users_collection.find_one({"_id": ctx.author.id})
-        if not user_data or user_data['balance'] < total_cost:
+        if await self.balances.get(ctx.author.id) < total_cost:
             embed = discord.Embed(description=f"Insufficient balance to redeem {amount} {reward['name']}.",
                                   color=0xffcba4)
             await ctx.send(embed=embed)
@@ -656,54 +2071,23 @@ class ColorGame(commands.Cog):
         embed = discord.Embed(description="Waiting approval from admins", color=0xffcba4)
         await ctx.reply(embed=embed)
 
-        admin_channel = self.client.get_channel(1256432375626207283)
+        admin_channel = self.client.get_channel(self.admin_channel_id)
         message = await admin_channel.send(
             f"Redemption request from {ctx.author.mention} for {amount} {reward['name']} worth {EMOJI_PESO_COIN}{total_cost} peso coins. React with ✅ to approve.")
+        await self.approvals.submit(
+            message.id, kind="redeem", user_id=ctx.author.id, display_name=ctx.author.display_name,
+            amount=amount, reward_name=reward['name'], total_cost=total_cost, channel_id=ctx.channel.id,
+            request_message_id=ctx.message.id, admin_channel_id=admin_channel.id)
+        self.reactions.register(message.id, self.handle_approval, kind="approval")
         await message.add_reaction('✅')
 
-        def check(reaction, user):
-            return user != self.client.user and str(reaction.emoji) == '✅' and any(
-                role.name == 'admin' for role in user.roles)
-
-        try:
-            reaction, user = await self.client.wait_for('reaction_add', timeout=86400.0, check=check)
-            new_balance = user_data['balance'] - total_cost
-            users_collection.update_one({"_id": ctx.author.id}, {"$set": {"balance": new_balance}})
-            embed = discord.Embed(
-                title="Approved!",
-                description=f"{amount} {reward['name']} redeemed for {EMOJI_PESO_COIN}{total_cost} peso coins. New balance: {EMOJI_PESO_COIN}{new_balance}.",
-                color=0xffcba4)
-            await ctx.reply(embed=embed)
-
-            redeemed_coins_collection.insert_one({
-                "user_id": ctx.author.id,
-                "amount": total_cost,
-                "date": datetime.datetime.now()
-            })
-        except asyncio.TimeoutError:
-            await admin_channel.send(
-                f"No one responded to the redemption request from {ctx.author.display_name} in time. It has been canceled.")
-
     @commands.command()
     @in_allowed_channels()
     @is_specific_user()
     async def view_profits(self, ctx):
-        total_given_result = given_coins_collection.aggregate([
-            {"$group": {"_id": None, "total_given": {"$sum": "$amount"}}}
-        ])
-        total_given_amount = total_given_result.next().get('total_given', 0) if total_given_result.alive else 0
-
-        total_lost_result = lost_bets_collection.aggregate([
-            {"$group": {"_id": None, "total_lost": {"$sum": "$amount"}}}
-        ])
-        total_lost_amount = total_lost_result.next().get('total_lost', 0) if total_lost_result.alive else 0
-
-        total_redeemed_result = redeemed_coins_collection.aggregate([
-            {"$group": {"_id": None, "total_redeemed": {"$sum": "$amount"}}}
-        ])
-        total_redeemed_amount = total_redeemed_result.next().get('total_redeemed', 0) if total_redeemed_result.alive else 0
-
-        total_profit = total_lost_amount - total_redeemed_amount
+        totals = await self.profits.read()
+        total_given_amount = totals["given"]
+        total_profit = totals["lost"] - totals["redeemed"]
 
         embed = discord.Embed(
             title="Total Profits",
@@ -719,40 +2103,171 @@ class ColorGame(commands.Cog):
     @in_allowed_channels()
     @is_specific_user()
     async def reset_balances(self, ctx):
-        users_collection.update_many({}, {"$set": {"balance": 0}})
-        await ctx.send(embed=discord.Embed(description="All user balances have been reset to zero.", color=0xffcba4))
+        await self.start_archive(ctx, ["balances"])
 
     @commands.command()
     @in_allowed_channels()
     @is_specific_user()
     async def reset_profits(self, ctx):
-        given_coins_collection.delete_many({})
-        lost_bets_collection.delete_many({})
-        redeemed_coins_collection.delete_many({})
-        await ctx.send(embed=discord.Embed(description="Profit tracking data has been reset.", color=0xffcba4))
+        await self.start_archive(ctx, ["profits"])
+
+    @commands.command()
+    @in_allowed_channels()
+    @is_specific_user()
+    async def new_season(self, ctx):
+        await self.start_archive(ctx, list(SeasonArchiver.parts), rollover=True)
+
+    @commands.command()
+    @in_allowed_channels()
+    @is_specific_user()
+    async def season(self, ctx):
+        season = await self.archiver.season()
+        job = await self.archiver.running() or await self.store.archive_jobs.find_one(
+            {}, sort=[("started_at", DESCENDING)])
+        embed = discord.Embed(title=f"Season {season['number']}",
+                              description=f"Started {season['started_at']:%Y-%m-%d %H:%M}.", color=0xffcba4)
+        if job:
+            status = self.archive_embed(job, "")
+            embed.add_field(name=f"Last archive job ({job['status']})", value=status.description, inline=False)
+        await ctx.reply(embed=embed)
 
     @commands.command()
     @in_allowed_channels()
     @is_specific_user()
     async def adjust_total_given(self, ctx, amount: int):
-        given_coins_collection.insert_one({
+        await self.profits.record("given", [{
             "user_id": "manual_adjustment",
             "amount": amount,
             "date": datetime.datetime.now()
-        })
+        }])
         await ctx.send(embed=discord.Embed(description=f"Total given adjusted by {EMOJI_PESO_COIN}{amount}.", color=0xffcba4))
 
     @commands.command()
     @in_allowed_channels()
     @is_specific_user()
     async def adjust_profits(self, ctx, amount: int):
-        lost_bets_collection.insert_one({
+        await self.profits.record("lost", [{
             "user_id": "manual_adjustment",
             "amount": amount,
             "date": datetime.datetime.now()
-        })
+        }])
         await ctx.send(embed=discord.Embed(description=f"Total profits adjusted by {EMOJI_PESO_COIN}{amount}.", color=0xffcba4))
 
+    @commands.command()
+    @in_allowed_channels()
+    @is_specific_user()
+    async def reconcile_profits(self, ctx):
+        totals = await self.profits.reconcile()
+        await ctx.send(embed=discord.Embed(
+            description=f"Profit counters rebuilt from the logs: given {EMOJI_PESO_COIN}{totals['given']}, "
+                        f"lost {EMOJI_PESO_COIN}{totals['lost']}, redeemed {EMOJI_PESO_COIN}{totals['redeemed']}.",
+            color=0xffcba4))
+
+    @commands.command()
+    @in_allowed_channels()
+    @is_specific_user()
+    async def audit(self, ctx, member: discord.Member = None):
+        if member:
+            replayed, entries = await self.ledger.balance(member.id)
+            user = await self.store.users.find_one({"_id": member.id}, {"balance": 1})
+            stored = user.get("balance", 0) if user else 0
+            status = "matches" if replayed == stored else f"differs by {stored - replayed}"
+            embed = discord.Embed(
+                title=f"Ledger audit: {member.display_name}",
+                description=(
+                    f"**Stored balance:** {EMOJI_PESO_COIN}{stored}\n"
+                    f"**Ledger balance:** {EMOJI_PESO_COIN}{replayed} ({status})\n"
+                    f"Replayed {entries} entries since the last snapshot."
+                ),
+                color=0xffcba4)
+        else:
+            totals = await self.ledger.totals()
+            house_take = -(totals["bet"]["amount"] + totals["refund"]["amount"] + totals["win"]["amount"])
+            lines = [f"**{kind}:** {EMOJI_PESO_COIN}{total['amount']} over {total['count']} entries"
+                     for kind, total in totals.items()]
+            embed = discord.Embed(title="Ledger totals",
+                                  description="\n".join(lines) + f"\n**House take:** {EMOJI_PESO_COIN}{house_take}",
+                                  color=0xffcba4)
+        await ctx.reply(embed=embed)
+
+    @commands.command()
+    @in_allowed_channels()
+    @is_specific_user()
+    async def ledger_snapshot(self, ctx):
+        folded = await self.ledger.snapshot()
+        await ctx.reply(embed=discord.Embed(description=f"Folded {folded} ledger entries into the balance snapshot.",
+                                            color=0xffcba4))
+
+    def perf_gauges(self):
+        gauges = {
+            "colorgame_mongo_round_trips_total": self.store.round_trips,
+            "colorgame_tables": len(self.tables),
+            "colorgame_open_rounds": sum(table.betting_open for table in self.tables.values()),
+            "colorgame_bet_writes_pending": sum(len(table.bet_writes.pending) for table in self.tables.values()),
+            "colorgame_bet_write_flushes_total": sum(table.bet_writes.flushes for table in self.tables.values()),
+            "colorgame_messages_sent_total": self.output.messages_sent,
+        }
+        gauges.update({f"colorgame_member_cache_{key}": value for key, value in self.member_cache.stats().items()})
+        gauges.update({f"colorgame_balance_cache_{key}": value for key, value in self.balances.cache.stats().items()})
+        gauges.update({f"colorgame_reaction_routes_{kind}": count for kind, count in self.reactions.stats().items()})
+        for feed in self.feeds:
+            gauges[f"colorgame_change_events_{feed.collection.name}_total"] = feed.events
+            gauges[f"colorgame_change_stream_restarts_{feed.collection.name}_total"] = feed.restarts
+        return gauges
+
+    @commands.command()
+    @in_allowed_channels()
+    @is_specific_user()
+    async def perf(self, ctx, output: str = None):
+        metrics = self.metrics
+        if output == "reset":
+            metrics.reset()
+            await ctx.reply("Performance metrics reset.")
+            return
+        if output == "prometheus":
+            text = metrics.render_prometheus(self.perf_gauges())
+            await ctx.reply(file=discord.File(io.BytesIO(text.encode()), filename="colorgame_metrics.prom"))
+            return
+
+        ms = 1000
+        rows = sorted(metrics.commands.items(), key=lambda item: item[1].count, reverse=True)[:12]
+        command_table = "\n".join(
+            f"{name[:14]:<14}{hist.count:>6}{hist.quantile(0.5) * ms:>8.1f}{hist.quantile(0.95) * ms:>8.1f}"
+            f"{hist.quantile(0.99) * ms:>8.1f}{metrics.command_calls[name].sum / hist.count:>6.1f}"
+            for name, hist in rows)
+        ops = sorted(metrics.ops.items(), key=lambda item: item[1].sum, reverse=True)[:10]
+        op_table = "\n".join(
+            f"{key[:26]:<26}{hist.count:>6}{hist.quantile(0.95) * ms:>8.1f}{hist.sum:>8.2f}"
+            for key, hist in ops)
+
+        embed = discord.Embed(title="Performance", description=f"Since {metrics.since:%Y-%m-%d %H:%M:%S}",
+                              color=0xffcba4)
+        embed.add_field(name="Commands", inline=False, value=(
+            f"```{'command':<14}{'count':>6}{'p50ms':>8}{'p95ms':>8}{'p99ms':>8}{'db':>6}\n{command_table}```"
+            if rows else "No commands run yet."))
+        embed.add_field(name="Slowest calls by total time", inline=False, value=(
+            f"```{'op':<26}{'count':>6}{'p95ms':>8}{'total s':>8}\n{op_table}```" if ops else "No calls recorded."))
+        lag = metrics.loop_lag
+        embed.add_field(name="Event loop lag", inline=False, value=(
+            f"p50 {lag.quantile(0.5) * ms:.1f} ms, p99 {lag.quantile(0.99) * ms:.1f} ms, max {lag.max * ms:.1f} ms"))
+        for name, cache in (("Member cache", self.member_cache.stats()), ("Balance cache", self.balances.cache.stats())):
+            embed.add_field(name=name, value=(
+                f"{cache['size']} entries, {cache['hit_rate']:.0%} hit rate ({cache['hits']}/{cache['hits'] + cache['misses']})"))
+        embed.add_field(name="Reaction routes", value=", ".join(
+            f"{kind}: {count}" for kind, count in self.reactions.stats().items()))
+        if metrics.errors:
+            embed.add_field(name="Errors", inline=False,
+                            value=", ".join(f"{name}: {count}" for name, count in metrics.errors.most_common(10)))
+        await ctx.reply(embed=embed)
+
 
-async def setup(client):
-    await client.add_cog(ColorGame(client))
+async def setup(client, config=None):
+    started = time.perf_counter()
+    config = config or MongoConfig.from_env()
+    store = MongoStore.from_config(config)
+    await store.ensure_indexes(retention_days=config.log_retention_days)
+    await store.verify_query_plans(strict=os.getenv('COLORGAME_STRICT_QUERY_PLANS') == '1')
+    cog = ColorGame(client, store, shared=config.shared)
+    await client.add_cog(cog)
+    cog.load_seconds = time.perf_counter() - started
+    log.info("ColorGame loaded in %.1f ms", cog.load_seconds * 1000)
@@ -0,0 +1,238 @@
+import asyncio
+import csv
+import datetime
+import functools
+import gzip
+import json
+import os
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReplaceOne, ReturnDocument
+
+
+class Exporter:
+    """Streams a log collection to a gzipped CSV or JSON Lines file in ``_id``-ordered batches."""
+
+    sources = {
+        "rolls": ("roll_history", ("_id", "date", "channel_id", "session_id", "results")),
+        "bets": ("bets", ("_id", "date", "session_id", "user_id", "color", "amount")),
+        "given": ("given_coins", ("_id", "date", "user_id", "amount")),
+        "lost": ("lost_bets", ("_id", "date", "user_id", "amount")),
+        "redeemed": ("redeemed_coins", ("_id", "date", "user_id", "amount")),
+        "ledger": ("ledger", ("_id", "date", "type", "user_id", "amount", "balance", "session_id", "color", "stake",
+                              "counterparty", "admin_id", "source", "approval_id", "reason")),
+    }
+    formats = ("jsonl", "csv")
+
+    def __init__(self, store, batch_size=1000):
+        self.store = store
+        self.batch_size = batch_size
+
+    @staticmethod
+    def plain(value):
+        if isinstance(value, ObjectId):
+            return str(value)
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        if isinstance(value, (list, tuple)):
+            return [Exporter.plain(item) for item in value]
+        if isinstance(value, dict):
+            return {key: Exporter.plain(item) for key, item in value.items()}
+        return value
+
+    @classmethod
+    def filter(cls, start=None, end=None, after=None):
+        query = {}
+        if start or end:
+            query["date"] = {key: value for key, value in (("$gte", start), ("$lt", end)) if value}
+        if after:
+            query["_id"] = {"$gt": ObjectId(after) if ObjectId.is_valid(after) else after}
+        return query
+
+    async def export(self, source, path, fmt="jsonl", start=None, end=None, after=None, progress=None, season=None):
+        """Write ``source`` documents dated in [start, end) after ``after`` to ``path``; returns (count, last_id)."""
+        name, columns = self.sources[source]
+        collection = self.store.collection(f"season_{season}_{name}") if season else getattr(self.store, name)
+        loop = asyncio.get_running_loop()
+        query = self.filter(start, end, after)
+        count, last_id = 0, None
+        append = bool(after) and os.path.exists(path)
+        out = await loop.run_in_executor(None, functools.partial(
+            gzip.open, path, "at" if append else "wt", encoding="utf-8", newline=""))
+        try:
+            writer = csv.writer(out)
+            if fmt == "csv" and not append:
+                writer.writerow(columns)
+            while True:
+                batch = await collection.find(query, sort=[("_id", ASCENDING)], limit=self.batch_size)
+                if not batch:
+                    break
+                if fmt == "csv":
+                    rows = [[self.cell(document.get(column)) for column in columns] for document in batch]
+                    await loop.run_in_executor(None, writer.writerows, rows)
+                else:
+                    lines = "".join(json.dumps(self.plain(document), default=str) + "\n" for document in batch)
+                    await loop.run_in_executor(None, out.write, lines)
+                count += len(batch)
+                last_id = batch[-1]["_id"]
+                query["_id"] = {"$gt": last_id}
+                if progress:
+                    await progress(count, last_id)
+                if len(batch) < self.batch_size:
+                    break
+        finally:
+            await loop.run_in_executor(None, out.close)
+        return count, last_id
+
+    @classmethod
+    def cell(cls, value):
+        value = cls.plain(value)
+        if isinstance(value, (list, dict)):
+            return json.dumps(value)
+        return "" if value is None else value
+
+
+class SeasonArchiver:
+    """Moves balances and logs into ``season_<n>_*`` collections in resumable, transactional batches."""
+
+    parts = {
+        "balances": ("users",),
+        "history": ("roll_history",),
+        "profits": ("given_coins", "lost_bets", "redeemed_coins"),
+    }
+    state_id = "season"
+    lease = 120.0  # Seconds without a heartbeat before another process may take a job over
+
+    def __init__(self, store, balances, profits, batch_size=1000, pause=0.05):
+        self.store = store
+        self.balances = balances
+        self.profits = profits
+        self.batch_size = batch_size
+        self.pause = pause  # Seconds between batches, so archiving never crowds out commands
+        self.kinds = {log.name: kind for kind, log in profits.logs.items()}
+
+    async def season(self):
+        """``{number, started_at}`` of the current season, starting season 1 if there is none yet."""
+        return await self.store.counters.find_one_and_update(
+            {"_id": self.state_id}, {"$setOnInsert": {"number": 1, "started_at": datetime.datetime.now()}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+
+    def archive(self, season, name):
+        return self.store.collection(f"season_{season}_{name}")
+
+    async def running(self):
+        return await self.store.archive_jobs.find_one({"status": "running"})
+
+    async def start(self, parts, rollover=False, **details):
+        """Create a job archiving ``parts``; returns it, or None if another job is still running."""
+        if await self.running():
+            return None
+        season = await self.season()
+        sources = [name for part in parts for name in self.parts[part]]
+        totals = {}
+        for name in sources:
+            totals[name] = await getattr(self.store, name).estimated_document_count()
+        job = dict(details, _id=ObjectId(), status="running", season=season["number"], parts=list(parts),
+                   rollover=rollover, sources=sources, upto=ObjectId(), cursors={}, moved=dict.fromkeys(sources, 0),
+                   totals=totals, profits={}, started_at=datetime.datetime.now(), heartbeat_at=datetime.datetime.now())
+        await self.store.archive_jobs.insert_one(job)
+        return job
+
+    async def claim_stale(self):
+        """Take over a running job whose owner stopped sending heartbeats; None if there is none."""
+        now = datetime.datetime.now()
+        return await self.store.archive_jobs.find_one_and_update(
+            {"status": "running", "heartbeat_at": {"$lt": now - datetime.timedelta(seconds=self.lease)}},
+            {"$set": {"heartbeat_at": now}}, return_document=ReturnDocument.AFTER)
+
+    async def run(self, job, progress=None):
+        """Archive every source of ``job`` from its cursor on; ``progress(job)`` is awaited after each batch."""
+        for name in job["sources"]:
+            while not job.get("done", {}).get(name):
+                if name == "users":
+                    await self._reset_balances(job)
+                else:
+                    await self._move_log(job, name)
+                if progress:
+                    await progress(job)
+                await asyncio.sleep(self.pause)
+        return await self._finish(job)
+
+    def _progress(self, job, name, batch, last_id, session, **increments):
+        """Advance ``job``'s cursor for ``name`` in Mongo (inside the batch's transaction) and locally."""
+        now = datetime.datetime.now()
+        update = {"$set": {"heartbeat_at": now}}
+        if batch:
+            update["$set"][f"cursors.{name}"] = last_id
+            update["$inc"] = dict(increments, **{f"moved.{name}": len(batch)})
+        else:
+            update["$set"][f"done.{name}"] = True
+        self.store.archive_jobs.collection.update_one({"_id": job["_id"]}, update, session=session)
+
+    def _apply(self, job, name, batch, last_id, **increments):
+        job["heartbeat_at"] = datetime.datetime.now()
+        if not batch:
+            job.setdefault("done", {})[name] = True
+            return
+        job["cursors"][name] = last_id
+        job["moved"][name] = job["moved"].get(name, 0) + len(batch)
+        for key, value in increments.items():
+            section, field = key.split(".")
+            job[section][field] = job[section].get(field, 0) + value
+
+    async def _reset_balances(self, job):
+        archive = self.archive(job["season"], "balances").collection
+        now = datetime.datetime.now()
+
+        def also(users, session):
+            if users:
+                archive.bulk_write([
+                    ReplaceOne({"_id": {"job_id": job["_id"], "user_id": user["_id"]}},
+                               {"user_id": user["_id"], "balance": user["balance"], "archived_at": now}, upsert=True)
+                    for user in users], ordered=False, session=session)
+            self._progress(job, "users", users, users[-1]["_id"] if users else None, session)
+
+        batch = await self.balances.reset_batch(job["cursors"].get("users"), self.batch_size, also=also,
+                                                reason="season", season=job["season"])
+        self._apply(job, "users", batch, batch[-1]["_id"] if batch else None)
+
+    async def _move_log(self, job, name):
+        source = getattr(self.store, name).collection
+        archive = self.archive(job["season"], name).collection
+        counters = self.store.counters.collection
+        kind = self.kinds.get(name)
+        query = {"_id": {"$lte": job["upto"]}}
+        if job["cursors"].get(name):
+            query["_id"]["$gt"] = job["cursors"][name]
+
+        def move(session):
+            batch = list(source.find(query, session=session).sort("_id", ASCENDING).limit(self.batch_size))
+            increments = {}
+            if batch:
+                archive.bulk_write([ReplaceOne({"_id": document["_id"]}, document, upsert=True)
+                                    for document in batch], ordered=False, session=session)
+                source.delete_many({"_id": {"$in": [document["_id"] for document in batch]}}, session=session)
+                if kind:
+                    total = sum(document.get("amount", 0) for document in batch)
+                    counters.update_one({"_id": self.profits.document_id}, {"$inc": {kind: -total}}, session=session)
+                    increments[f"profits.{kind}"] = total
+            self._progress(job, name, batch, batch[-1]["_id"] if batch else None, session, **increments)
+            return batch, increments
+
+        batch, increments = await self.store.transaction(move)
+        getattr(self.store, name).notify_change()
+        self._apply(job, name, batch, batch[-1]["_id"] if batch else None, **increments)
+
+    async def _finish(self, job):
+        if any(name in self.kinds for name in job["sources"]):
+            await self.profits.reconcile()
+        now = datetime.datetime.now()
+        if job["rollover"]:
+            # Only the job that still holds the season's number moves it on, even if two processes finish it
+            await self.store.counters.update_one(
+                {"_id": self.state_id, "number": job["season"]},
+                {"$set": {"number": job["season"] + 1, "started_at": now}})
+        await self.store.archive_jobs.update_one(
+            {"_id": job["_id"]}, {"$set": {"status": "finished", "finished_at": now}})
+        job.update(status="finished", finished_at=now)
+        return job
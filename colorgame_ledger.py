@@ -0,0 +1,383 @@
+import asyncio
+import contextlib
+import datetime
+import time
+import weakref
+from collections import OrderedDict
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+
+class BalanceCache:
+    """Write-through LRU of user balances; bulk writes bump ``epoch`` so fills started before them are dropped."""
+
+    def __init__(self, maxsize=10000, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.locks = weakref.WeakValueDictionary()
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lock(self, user_id):
+        lock = self.locks.get(user_id)
+        if lock is None:
+            lock = self.locks[user_id] = asyncio.Lock()
+        return lock
+
+    @contextlib.asynccontextmanager
+    async def locked(self, *user_ids):
+        """Hold the locks of ``user_ids``, taken in a fixed order so two transfers can't deadlock."""
+        async with contextlib.AsyncExitStack() as stack:
+            for user_id in sorted(set(user_ids)):
+                await stack.enter_async_context(self.lock(user_id))
+            yield
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.entries.move_to_end(user_id)
+        return True, entry[1]
+
+    def put(self, user_id, balance, epoch):
+        if epoch != self.epoch:
+            return
+        self.entries[user_id] = (time.monotonic() + self.ttl, balance)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def discard(self, user_id):
+        self.entries.pop(user_id, None)
+
+    def evict(self, user_ids):
+        self.epoch += 1
+        for user_id in user_ids:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        self.epoch += 1
+        self.entries.clear()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
+
+
+class BalanceService:
+    """Balance mutations, each one transaction with its ledger entries, cached write-through."""
+
+    def __init__(self, store, cache=None, ledger=None):
+        self.store = store
+        self.cache = cache or BalanceCache()
+        self.ledger = ledger
+
+    def record(self, entries, session):
+        """Append ledger ``entries`` inside the caller's transaction."""
+        if self.ledger:
+            self.ledger.insert(entries, session)
+
+    def writing(self):
+        return self.ledger.writing() if self.ledger else contextlib.nullcontext()
+
+    async def credit(self, user_id, amount, kind="give", also=None, **details):
+        """Add ``amount`` and return the new balance; ``also(session)`` runs first and raises to call it off."""
+        users = self.store.users.collection
+
+        def credit(session):
+            if also:
+                also(session)
+            user = users.find_one_and_update(
+                {"_id": user_id}, {"$inc": {"balance": amount}}, upsert=True,
+                return_document=ReturnDocument.AFTER, session=session)
+            self.record([TransactionLedger.entry(kind, user_id, amount, balance=user["balance"], **details)],
+                        session)
+            return user["balance"]
+
+        async with self.cache.lock(user_id):
+            epoch = self.cache.epoch
+            with self.writing():
+                balance = await self.store.transaction(credit)
+            self.store.users.notify_change()
+            self.cache.put(user_id, balance, epoch)
+        return balance
+
+    async def debit(self, user_id, amount, kind="bet", **details):
+        """Remove ``amount`` if the user can afford it; return the new balance or ``None``."""
+        users = self.store.users.collection
+
+        def debit(session):
+            user = users.find_one_and_update(
+                {"_id": user_id, "balance": {"$gte": amount}}, {"$inc": {"balance": -amount}},
+                return_document=ReturnDocument.AFTER, session=session)
+            if user:
+                self.record([TransactionLedger.entry(kind, user_id, -amount, balance=user["balance"], **details)],
+                            session)
+            return user and user["balance"]
+
+        async with self.cache.lock(user_id):
+            epoch = self.cache.epoch
+            with self.writing():
+                balance = await self.store.transaction(debit)
+            if balance is None:
+                self.cache.discard(user_id)  # Whatever was cached, it wasn't enough
+                return None
+            self.store.users.notify_change()
+            self.cache.put(user_id, balance, epoch)
+        return balance
+
+    async def adjust(self, user_id, delta, **details):
+        """Apply ``delta`` unless it would take the balance below zero."""
+        if delta >= 0:
+            return await self.credit(user_id, delta, kind="adjust", **details)
+        return await self.debit(user_id, -delta, kind="adjust", **details)
+
+    async def transfer(self, from_id, to_id, amount):
+        """Move ``amount`` between users; return the sender's new balance or ``None``."""
+        users = self.store.users.collection
+
+        def transfer(session):
+            sender = users.find_one_and_update(
+                {"_id": from_id, "balance": {"$gte": amount}}, {"$inc": {"balance": -amount}},
+                return_document=ReturnDocument.AFTER, session=session)
+            if not sender:
+                return None
+            recipient = users.find_one_and_update(
+                {"_id": to_id}, {"$inc": {"balance": amount}}, upsert=True,
+                return_document=ReturnDocument.AFTER, session=session)
+            self.record([TransactionLedger.entry("gift", from_id, -amount, counterparty=to_id),
+                         TransactionLedger.entry("gift", to_id, amount, counterparty=from_id)], session)
+            return sender["balance"], recipient["balance"]
+
+        async with self.cache.locked(from_id, to_id):
+            epoch = self.cache.epoch
+            with self.writing():
+                balances = await self.store.transaction(transfer)
+            if balances is None:
+                self.cache.discard(from_id)
+                return None
+            self.store.users.notify_change()
+            self.cache.put(to_id, balances[1], epoch)
+            self.cache.put(from_id, balances[0], epoch)  # Last, in case the user gifted themselves
+        return balances[0]
+
+    async def credit_many(self, amounts, kind="give", also=None, **details):
+        """Add ``{user_id: amount}`` in one bulk write; ``also(session)`` runs first, returning False to call it off."""
+        if not amounts and not also:
+            return True
+        users = self.store.users.collection
+
+        def credit(session):
+            if also and also(session) is False:
+                return False
+            if amounts:
+                users.bulk_write([UpdateOne({"_id": user_id}, {"$inc": {"balance": amount}}, upsert=True)
+                                  for user_id, amount in amounts.items()], ordered=False, session=session)
+                self.record([TransactionLedger.entry(kind, user_id, amount, **details)
+                             for user_id, amount in amounts.items()], session)
+            return True
+
+        try:
+            with self.writing():
+                credited = await self.store.transaction(credit)
+        finally:
+            self.cache.evict(amounts)
+        if credited:
+            self.store.users.notify_change()
+        return credited
+
+    async def reset_batch(self, after=None, limit=1000, also=None, **details):
+        """Zero the next ``limit`` non-zero balances after ``after``; returns them as they were."""
+        users = self.store.users.collection
+
+        def reset(session):
+            query = {"balance": {"$ne": 0}}
+            if after is not None:
+                query["_id"] = {"$gt": after}
+            batch = list(users.find(query, {"balance": 1}, session=session).sort("_id", ASCENDING).limit(limit))
+            if batch:
+                users.update_many({"_id": {"$in": [user["_id"] for user in batch]}}, {"$set": {"balance": 0}},
+                                  session=session)
+                self.record([TransactionLedger.entry("adjust", user["_id"], -user["balance"], **details)
+                             for user in batch], session)
+            if also:
+                also(batch, session)
+            return batch
+
+        try:
+            with self.writing():
+                batch = await self.store.transaction(reset)
+        except BaseException:
+            self.cache.clear()
+            raise
+        self.cache.evict([user["_id"] for user in batch])
+        self.store.users.notify_change()
+        return batch
+
+    async def get(self, user_id):
+        found, balance = self.cache.get(user_id)
+        if found:
+            return balance
+        async with self.cache.lock(user_id):
+            epoch = self.cache.epoch
+            user = await self.store.users.find_one({"_id": user_id}, {"balance": 1})
+            balance = user.get("balance", 0) if user else 0
+            self.cache.put(user_id, balance, epoch)
+            return balance
+
+
+class TransactionLedger:
+    """Append-only record of every coin movement, folded into periodic snapshots."""
+
+    types = ("bet", "refund", "win", "loss", "gift", "give", "redeem", "adjust")
+    state_id = "ledger"
+
+    def __init__(self, store, lag=0.0):
+        self.store = store
+        self.lag = lag  # Seconds the snapshot cut trails now, for entries other processes are still committing
+        self.lock = asyncio.Lock()  # Keeps replays from reading across a snapshot being folded
+        self.in_flight = set()  # One event per transaction that may still be inserting entries
+
+    @contextlib.contextmanager
+    def writing(self):
+        """Wrap a transaction that inserts entries; snapshots wait for it if it started before their cut."""
+        done = asyncio.Event()
+        self.in_flight.add(done)
+        try:
+            yield
+        finally:
+            self.in_flight.discard(done)
+            done.set()
+
+    @staticmethod
+    def entry(type, user_id, amount, **details):
+        return dict(details, _id=ObjectId(), type=type, user_id=user_id, amount=amount,
+                    date=datetime.datetime.now())
+
+    def insert(self, entries, session):
+        """Append ``entries`` inside the caller's transaction."""
+        if entries:
+            self.store.ledger.collection.insert_many(entries, ordered=False, session=session)
+
+    async def open_books(self):
+        """Seed the first snapshot from the current balances; False if the ledger already has one."""
+        counters = self.store.counters.collection
+        users = self.store.users.collection
+        snapshots = self.store.balance_snapshots.collection
+
+        def seed(session):
+            if counters.find_one({"_id": self.state_id}, session=session):
+                return False
+            balances = list(users.find({"balance": {"$ne": 0}}, {"balance": 1}, session=session))
+            if balances:
+                snapshots.bulk_write(
+                    [UpdateOne({"_id": user["_id"]}, {"$set": {"balance": user["balance"]}}, upsert=True)
+                     for user in balances], ordered=False, session=session)
+            counters.insert_one({"_id": self.state_id, "upto": ObjectId(), "totals": {},
+                                 "opened_at": datetime.datetime.now()}, session=session)
+            return True
+
+        async with self.lock:
+            return await self.store.transaction(seed)
+
+    def _since(self, state, match=None):
+        match = dict(match or {})
+        if state and state.get("upto"):
+            match["_id"] = {"$gt": state["upto"]}
+        return match
+
+    async def snapshot(self):
+        """Fold every entry since the last snapshot into it; returns how many entries were folded."""
+        counters = self.store.counters.collection
+        entries = self.store.ledger.collection
+        snapshots = self.store.balance_snapshots.collection
+
+        async with self.lock:
+            # Entries are created inside their transaction, so any with an id below the cut belongs to a
+            # transaction already in flight here; wait for those before folding up to the cut
+            started = list(self.in_flight)
+            if self.lag:
+                cut = ObjectId.from_datetime(
+                    datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.lag))
+            else:
+                cut = ObjectId()
+            for done in started:
+                await done.wait()
+
+            def fold(session):
+                state = counters.find_one({"_id": self.state_id}, session=session)
+                match = self._since(state)
+                match.setdefault("_id", {})["$lte"] = cut
+                balances = list(entries.aggregate([
+                    {"$match": match},
+                    {"$group": {"_id": "$user_id", "amount": {"$sum": "$amount"}}},
+                ], session=session))
+                totals = list(entries.aggregate([
+                    {"$match": match},
+                    {"$group": {"_id": "$type", "amount": {"$sum": "$amount"}, "count": {"$sum": 1}}},
+                ], session=session))
+                if balances:
+                    snapshots.bulk_write(
+                        [UpdateOne({"_id": row["_id"]}, {"$inc": {"balance": row["amount"]}}, upsert=True)
+                         for row in balances], ordered=False, session=session)
+                update = {"$set": {"upto": cut, "taken_at": datetime.datetime.now()}}
+                increments = {}
+                for row in totals:
+                    increments[f"totals.{row['_id']}.amount"] = row["amount"]
+                    increments[f"totals.{row['_id']}.count"] = row["count"]
+                if increments:
+                    update["$inc"] = increments
+                counters.update_one({"_id": self.state_id}, update, upsert=True, session=session)
+                return sum(row["count"] for row in totals)
+
+            return await self.store.transaction(fold)
+
+    async def balance(self, user_id):
+        """Replay ``user_id``'s balance: ``(balance, entries read since the snapshot)``."""
+        counters = self.store.counters.collection
+        entries = self.store.ledger.collection
+        snapshots = self.store.balance_snapshots.collection
+
+        def replay(session):
+            state = counters.find_one({"_id": self.state_id}, session=session)
+            snapshot = snapshots.find_one({"_id": user_id}, session=session)
+            rows = list(entries.aggregate([
+                {"$match": self._since(state, {"user_id": user_id})},
+                {"$group": {"_id": None, "amount": {"$sum": "$amount"}, "count": {"$sum": 1}}},
+            ], session=session))
+            balance = snapshot["balance"] if snapshot else 0
+            return (balance + rows[0]["amount"], rows[0]["count"]) if rows else (balance, 0)
+
+        async with self.lock:
+            return await self.store.transaction(replay)
+
+    async def totals(self):
+        """``{type: {"amount": .., "count": ..}}`` over the whole ledger."""
+        counters = self.store.counters.collection
+        entries = self.store.ledger.collection
+
+        def replay(session):
+            state = counters.find_one({"_id": self.state_id}, session=session)
+            totals = {type: dict(amount=0, count=0) for type in self.types}
+            for type, values in ((state or {}).get("totals") or {}).items():
+                totals.setdefault(type, dict(amount=0, count=0)).update(values)
+            for row in entries.aggregate([
+                {"$match": self._since(state)},
+                {"$group": {"_id": "$type", "amount": {"$sum": "$amount"}, "count": {"$sum": 1}}},
+            ], session=session):
+                total = totals.setdefault(row["_id"], dict(amount=0, count=0))
+                total["amount"] += row["amount"]
+                total["count"] += row["count"]
+            return totals
+
+        async with self.lock:
+            return await self.store.transaction(replay)
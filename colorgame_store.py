@@ -0,0 +1,475 @@
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReadPreference
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+
+try:
+    import mongomock
+except ImportError:  # only needed for the in-memory backend
+    mongomock = None
+
+log = logging.getLogger(__name__)
+
+
+# InvocationStats of the command running in the current task, if any
+current_invocation = contextvars.ContextVar("colorgame_invocation", default=None)
+
+
+def record_call(key, seconds):
+    """Attribute one Mongo (``collection.op``) or gateway call to the running command."""
+    invocation = current_invocation.get()
+    if invocation is not None:
+        invocation.record(key, seconds)
+
+
+def plan_stages(plan):
+    """Yield every ``stage`` name in an ``explain()`` plan tree."""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+class AsyncCollection:
+    """Awaitable pymongo collection whose calls run on the store's thread pool."""
+
+    write_methods = frozenset(("insert_one", "insert_many", "update_one", "update_many", "find_one_and_update",
+                               "delete_one", "delete_many", "bulk_write"))
+
+    def __init__(self, store, collection):
+        self.store = store
+        self.collection = collection
+        self.name = collection.name
+        self.on_change = []  # Callbacks run after every write, e.g. cache invalidation
+
+    async def _run(self, op, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await self.store.run(fn, *args, **kwargs)
+        finally:
+            record_call(f"{self.name}.{op}", time.perf_counter() - started)
+
+    async def _call(self, method, *args, **kwargs):
+        result = await self._run(method, getattr(self.collection, method), *args, **kwargs)
+        if method in self.write_methods:
+            self.notify_change()
+        return result
+
+    def notify_change(self):
+        for callback in self.on_change:
+            callback()
+
+    async def find_one(self, *args, **kwargs):
+        return await self._call('find_one', *args, **kwargs)
+
+    async def find(self, filter=None, projection=None, sort=None, skip=0, limit=0):
+        def query():
+            cursor = self.collection.find(filter or {}, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            if skip:
+                cursor = cursor.skip(skip)
+            if limit:
+                cursor = cursor.limit(limit)
+            return list(cursor)
+
+        return await self._run('find', query)
+
+    async def aggregate(self, pipeline, **kwargs):
+        return await self._run('aggregate', lambda: list(self.collection.aggregate(pipeline, **kwargs)))
+
+    async def count_documents(self, filter, **kwargs):
+        return await self._call('count_documents', filter, **kwargs)
+
+    async def estimated_document_count(self, **kwargs):
+        return await self._call('estimated_document_count', **kwargs)
+
+    async def insert_one(self, document, **kwargs):
+        return await self._call('insert_one', document, **kwargs)
+
+    async def insert_many(self, documents, **kwargs):
+        return await self._call('insert_many', documents, **kwargs)
+
+    async def update_one(self, filter, update, **kwargs):
+        return await self._call('update_one', filter, update, **kwargs)
+
+    async def update_many(self, filter, update, **kwargs):
+        return await self._call('update_many', filter, update, **kwargs)
+
+    async def find_one_and_update(self, filter, update, **kwargs):
+        return await self._call('find_one_and_update', filter, update, **kwargs)
+
+    async def delete_one(self, filter, **kwargs):
+        return await self._call('delete_one', filter, **kwargs)
+
+    async def delete_many(self, filter, **kwargs):
+        return await self._call('delete_many', filter, **kwargs)
+
+    async def bulk_write(self, requests, **kwargs):
+        return await self._call('bulk_write', requests, **kwargs)
+
+    async def create_index(self, keys, **kwargs):
+        return await self._call('create_index', keys, **kwargs)
+
+    async def explain(self, filter, sort=None):
+        def explain():
+            cursor = self.collection.find(filter)
+            if sort:
+                cursor = cursor.sort(sort)
+            return cursor.explain()
+
+        return await self._run('explain', explain)
+
+
+@dataclass
+class MongoConfig:
+    """Connection settings for the cog's MongoStore, read from the environment by default."""
+    uri: str = None
+    database: str = "discord"
+    backend: str = "mongo"
+    max_workers: int = 8
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    server_selection_timeout_ms: int = 5000
+    read_preference: str = "primary"
+    write_concern: str = None
+    journal: bool = None
+    shared: bool = False  # Round state and table limits synced between processes through change streams
+    log_retention_days: float = None  # TTL on roll history and the given/lost/redeemed logs; None keeps them
+
+    @classmethod
+    def from_env(cls):
+        def env(name, default, cast=str):
+            value = os.getenv(f'COLORGAME_{name}')
+            return cast(value) if value not in (None, '') else default
+
+        return cls(
+            uri=os.getenv('MONGODB_URI'),
+            database=env('DATABASE', cls.database),
+            backend=env('BACKEND', cls.backend).lower(),
+            max_workers=env('DB_WORKERS', cls.max_workers, int),
+            max_pool_size=env('MAX_POOL_SIZE', cls.max_pool_size, int),
+            min_pool_size=env('MIN_POOL_SIZE', cls.min_pool_size, int),
+            server_selection_timeout_ms=env('SERVER_SELECTION_TIMEOUT_MS', cls.server_selection_timeout_ms, int),
+            read_preference=env('READ_PREFERENCE', cls.read_preference),
+            write_concern=env('WRITE_CONCERN', cls.write_concern),
+            journal=env('JOURNAL', cls.journal, lambda value: value.lower() in ('1', 'true', 'yes')),
+            shared=env('SHARED', cls.shared, lambda value: value.lower() in ('1', 'true', 'yes')),
+            log_retention_days=env('LOG_RETENTION_DAYS', cls.log_retention_days, float),
+        )
+
+    def client_kwargs(self):
+        kwargs = {
+            "maxPoolSize": self.max_pool_size,
+            "minPoolSize": self.min_pool_size,
+            "serverSelectionTimeoutMS": self.server_selection_timeout_ms,
+            "readPreference": self.read_preference,
+        }
+        if self.write_concern is not None:
+            kwargs["w"] = int(self.write_concern) if self.write_concern.isdigit() else self.write_concern
+        if self.journal is not None:
+            kwargs["journal"] = self.journal
+        return kwargs
+
+
+class MongoStore:
+    """Async data layer: pymongo on a bounded thread pool, or mongomock with ``in_memory()``."""
+
+    collection_names = ("users", "bets", "rounds", "approvals", "counters", "rollups", "roll_history",
+                        "given_coins", "lost_bets", "redeemed_coins", "ledger", "balance_snapshots", "tables",
+                        "archive_jobs")
+
+    def __init__(self, client, database="discord", max_workers=8, latency=0.0):
+        self.client = client
+        self.db = client[database]
+        self.latency = latency
+        self.round_trips = 0
+        self.in_memory = mongomock is not None and isinstance(client, mongomock.MongoClient)
+        self.transactions = not self.in_memory
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="colorgame-db")
+        for name in self.collection_names:
+            setattr(self, name, AsyncCollection(self, self.db[name]))
+
+    @classmethod
+    def from_uri(cls, uri, **kwargs):
+        return cls(MongoClient(uri), **kwargs)
+
+    @classmethod
+    def in_memory(cls, **kwargs):
+        if mongomock is None:
+            raise RuntimeError("The in-memory backend requires the mongomock package.")
+        return cls(mongomock.MongoClient(), **kwargs)
+
+    @classmethod
+    def from_config(cls, config):
+        if config.backend == 'memory':
+            return cls.in_memory(database=config.database, max_workers=config.max_workers)
+        return cls(MongoClient(config.uri, **config.client_kwargs()), database=config.database,
+                   max_workers=config.max_workers)
+
+    def collection(self, name):
+        return AsyncCollection(self, self.db[name])
+
+    async def ensure_indexes(self, retention_days=None):
+        await self.bets.create_index(
+            [("session_id", ASCENDING), ("user_id", ASCENDING), ("color", ASCENDING)], name="session_user_color")
+        await self.bets.create_index(
+            [("session_id", ASCENDING), ("user_id", ASCENDING), ("date", DESCENDING)], name="session_user_date")
+        await self.rounds.create_index([("status", ASCENDING), ("opened_at", DESCENDING)], name="status_opened")
+        # At most one unsettled round per channel, whichever process opens it
+        await self.rounds.create_index([("channel_id", ASCENDING)], name="active_channel", unique=True,
+                                       partialFilterExpression={"active": {"$exists": True}})
+        await self.users.create_index([("balance", DESCENDING), ("_id", ASCENDING)], name="balance_rank")
+        await self.approvals.create_index([("status", ASCENDING), ("expires_at", ASCENDING)], name="status_expiry")
+        await self.rollups.create_index([("granularity", ASCENDING), ("start", ASCENDING)], name="bucket")
+        await self.ensure_retention(self.roll_history, [("date", DESCENDING)], retention_days)
+        await self.ledger.create_index([("user_id", ASCENDING), ("_id", ASCENDING)], name="user_entries")
+        await self.ledger.create_index([("session_id", ASCENDING), ("type", ASCENDING)], name="round_entries",
+                                       sparse=True)
+        for collection in (self.given_coins, self.lost_bets, self.redeemed_coins):
+            await self.ensure_retention(collection, [("date", ASCENDING)], retention_days)
+        await self.archive_jobs.create_index([("status", ASCENDING)], name="status")
+
+    async def ensure_retention(self, collection, keys, days):
+        """Create a log's ``date`` index, as a TTL index expiring entries after ``days`` if given."""
+        if not days or self.in_memory:
+            try:
+                return await collection.create_index(keys, name="date")
+            except OperationFailure as e:
+                if self.in_memory or e.code not in (85, 86):  # IndexOptionsConflict, IndexKeySpecsConflict
+                    raise
+                await collection._run('drop_index', collection.collection.drop_index, "date")
+                return await collection.create_index(keys, name="date")
+        seconds = int(days * 86400)
+        try:
+            await collection.create_index(keys, name="date", expireAfterSeconds=seconds)
+        except OperationFailure as e:
+            if e.code not in (85, 86):
+                raise
+            await self.run(self.db.command, "collMod", collection.name,
+                           index={"name": "date", "expireAfterSeconds": seconds})
+
+    def hot_queries(self):
+        """(name, collection, filter, sort) for every query the cog runs on a hot path."""
+        now = datetime.datetime.now()
+        return [
+            ("view_bets/cancel_bet", self.bets, {"session_id": ObjectId(), "user_id": 0}, [("date", DESCENDING)]),
+            ("round ledger", self.bets, {"session_id": ObjectId()}, None),
+            ("active round", self.rounds, {"status": {"$in": ["open", "closed"]}}, [("opened_at", DESCENDING)]),
+            ("leaderboard", self.users, {}, [("balance", DESCENDING), ("_id", ASCENDING)]),
+            ("rank", self.users, {"balance": {"$gt": 0}}, None),
+            ("approval expiry", self.approvals, {"status": "pending", "expires_at": {"$lte": now}}, None),
+            ("history", self.roll_history, {}, [("date", DESCENDING)]),
+            ("stats", self.rollups, {"granularity": "day", "start": {"$gte": now, "$lt": now}}, None),
+            ("ledger replay", self.ledger, {"user_id": 0, "_id": {"$gt": ObjectId()}}, None),
+            ("bet recovery", self.ledger, {"session_id": ObjectId(), "type": {"$in": ["bet", "refund"]}}, None),
+        ]
+
+    async def verify_query_plans(self, strict=False):
+        """Explain every hot query and report the ones doing a COLLSCAN, or raise if ``strict``."""
+        if self.in_memory:
+            return []
+        scans = []
+        for name, collection, filter, sort in self.hot_queries():
+            plan = await collection.explain(filter, sort)
+            if "COLLSCAN" in plan_stages(plan.get("queryPlanner", {}).get("winningPlan", plan)):
+                log.warning("Query %r on %s does a COLLSCAN", name, collection.name)
+                scans.append(name)
+        if scans and strict:
+            raise RuntimeError(f"Hot queries without a usable index: {', '.join(scans)}")
+        return scans
+
+    async def run(self, fn, *args, **kwargs):
+        self.round_trips += 1
+        call = functools.partial(fn, *args, **kwargs)
+        if self.latency:
+            call = functools.partial(self._delayed, call)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def transaction(self, fn):
+        """Run ``fn(session)`` in a transaction, or ``fn(None)`` where transactions aren't supported."""
+        def run():
+            if self.transactions:
+                try:
+                    with self.client.start_session() as session:
+                        return session.with_transaction(fn, read_preference=ReadPreference.PRIMARY)
+                except OperationFailure as e:
+                    if e.code != 20:  # IllegalOperation: not a replica set member or mongos
+                        raise
+                    self.transactions = False
+            return fn(None)
+
+        started = time.perf_counter()
+        try:
+            return await self.run(run)
+        finally:
+            record_call("transaction", time.perf_counter() - started)
+
+    def _delayed(self, call):
+        time.sleep(self.latency)
+        return call()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.client.close()
+
+
+class ChangeFeed:
+    """Tails a collection's change stream on its own thread, resuming from the last token or resyncing."""
+
+    history_lost = (136, 280, 286)  # CappedPositionLost, ChangeStreamFatalError, ChangeStreamHistoryLost
+
+    def __init__(self, collection, handler, resync=None, pipeline=None, full_document=None, max_await_ms=1000):
+        self.collection = collection
+        self.handler = handler
+        self.resync = resync
+        self.pipeline = pipeline or []
+        self.full_document = full_document
+        self.max_await_ms = max_await_ms
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"colorgame-watch-{collection.name}")
+        self.stream = None
+        self.resume_token = None
+        self.task = None
+        self.events = 0
+        self.restarts = 0
+
+    async def _in_thread(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args))
+
+    def _watch(self):
+        kwargs = {"max_await_time_ms": self.max_await_ms}
+        if self.full_document:
+            kwargs["full_document"] = self.full_document
+        if self.resume_token:
+            kwargs["resume_after"] = self.resume_token
+        return self.collection.collection.watch(self.pipeline, **kwargs)
+
+    async def open(self):
+        """Start the stream; call before loading the state it keeps current, so no change is missed."""
+        if self.stream is None:
+            self.stream = await self._in_thread(self._watch)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        resync = False
+        while True:
+            delay = 0
+            try:
+                if resync:
+                    self.resume_token = None
+                    await self.open()  # Before reloading, so changes made during the reload aren't skipped
+                    if self.resync:
+                        await self.resync()
+                    resync = False
+                await self.open()
+                while self.stream.alive:
+                    change = await self._in_thread(self.stream.try_next)
+                    if change is None:
+                        continue
+                    self.resume_token = self.stream.resume_token
+                    self.events += 1
+                    try:
+                        await self.handler(change)
+                    except Exception:
+                        log.exception("Failed to apply %s change %r", self.collection.name, change.get("_id"))
+                resync = True  # Invalidated, e.g. the collection was dropped or renamed
+            except OperationFailure as e:
+                if e.code in self.history_lost:
+                    log.warning("Change stream on %s lost its resume point; resyncing", self.collection.name)
+                    resync = True
+                else:
+                    log.exception("Change stream on %s failed; retrying", self.collection.name)
+                    delay = 1
+            except PyMongoError:
+                log.exception("Change stream on %s failed; retrying", self.collection.name)
+                delay = 1
+            self.restarts += 1
+            stream, self.stream = self.stream, None
+            if stream is not None:
+                with contextlib.suppress(PyMongoError):
+                    await self._in_thread(stream.close)
+            await asyncio.sleep(delay)
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.stream is not None:
+            self.executor.submit(self.stream.close)  # Queued behind the try_next still waiting
+        self.executor.shutdown(wait=False)
+
+
+class WriteBuffer:
+    """Optional write-behind buffer that inserts documents in batches; readers must ``await flush()`` first."""
+
+    def __init__(self, collection, max_batch=1, max_delay=0.05, name="bets"):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.name = name
+        self.pending = []
+        self.timer = None
+        self.lock = asyncio.Lock()
+        self.flushes = 0
+
+    async def add(self, document):
+        await self.extend([document])
+
+    async def extend(self, documents):
+        if self.max_batch <= 1:
+            if len(documents) == 1:
+                await self.collection.insert_one(documents[0])
+            elif documents:
+                await self.collection.insert_many(documents, ordered=False)
+            return
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        self.pending.extend(documents)
+        if len(self.pending) >= self.max_batch:
+            await self.flush()
+        elif self.pending and self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self._flush_soon)
+
+    def _flush_soon(self):
+        self.timer = None
+        asyncio.create_task(self.flush(raise_errors=False))
+
+    async def flush(self, raise_errors=True):
+        """Write every queued document; returns once all earlier flushes have landed too."""
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        async with self.lock:
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # Documents that landed on an earlier attempt come back as duplicate keys; only the rest failed
+                if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                    self.pending[:0] = batch
+                    log.exception("Failed to flush %d buffered %s", len(batch), self.name)
+                    if raise_errors:
+                        raise
+            except Exception:
+                self.pending[:0] = batch
+                log.exception("Failed to flush %d buffered %s", len(batch), self.name)
+                if raise_errors:
+                    raise
+            self.flushes += 1
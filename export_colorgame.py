@@ -0,0 +1,70 @@
+"""Export ColorGame logs to gzip-compressed CSV or JSON Lines files.
+
+Streams roll history, bets, the given/lost/redeemed logs or the transaction
+ledger in ``_id`` order, a batch at a time, so memory stays flat however
+many rows there are. An interrupted export picks up where it stopped by
+passing the last id it printed to ``--after`` with the same ``--output``.
+``--season`` exports a season's archive instead of the live collection::
+
+    python export_colorgame.py rolls --start 2024-01-01 --end 2024-03-31 --format csv -o rolls.csv.gz
+    python export_colorgame.py ledger -o ledger.jsonl.gz --after 65f1c2d3e4a5b6c7d8e9f001
+    python export_colorgame.py lost --season 3 -o season3-lost.jsonl.gz
+"""
+import argparse
+import asyncio
+import datetime
+import sys
+import time
+
+from colorgame_archive import Exporter
+from colorgame_store import MongoConfig, MongoStore
+
+
+def date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+async def run(args):
+    config = MongoConfig.from_env()
+    if args.uri:
+        config.uri = args.uri
+    if args.database:
+        config.database = args.database
+    store = MongoStore.from_config(config)
+    exporter = Exporter(store, batch_size=args.batch)
+    started = last_report = time.monotonic()
+
+    async def progress(count, last_id):
+        nonlocal last_report
+        if time.monotonic() - last_report >= args.report_every:
+            last_report = time.monotonic()
+            print(f"{count} rows, last id {last_id}", file=sys.stderr)
+
+    end = args.end + datetime.timedelta(days=1) if args.end else None
+    try:
+        count, last_id = await exporter.export(args.source, args.output, args.format, args.start, end, args.after,
+                                               progress, season=args.season)
+    finally:
+        store.close()
+    print(f"Exported {count} {args.source} rows to {args.output} in {time.monotonic() - started:.1f}s"
+          + (f", last id {last_id}" if last_id else ""))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("source", choices=sorted(Exporter.sources))
+    parser.add_argument("-o", "--output", required=True, help="file to write, gzip-compressed")
+    parser.add_argument("--format", choices=Exporter.formats, default="jsonl")
+    parser.add_argument("--start", type=date, help="first day to include, YYYY-MM-DD")
+    parser.add_argument("--end", type=date, help="last day to include, YYYY-MM-DD")
+    parser.add_argument("--after", help="only rows after this _id; appends to --output if it exists")
+    parser.add_argument("--season", type=int, help="export this season's archive (season_<n>_* collections)")
+    parser.add_argument("--batch", type=int, default=1000, help="documents per query")
+    parser.add_argument("--report-every", type=float, default=5.0, help="seconds between progress lines")
+    parser.add_argument("--uri", help="MongoDB URI (default: MONGODB_URI)")
+    parser.add_argument("--database", help="database name (default: COLORGAME_DATABASE or discord)")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
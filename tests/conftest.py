@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from colorgame_store import MongoStore  # noqa: E402
+
+
+@pytest.fixture
+def store():
+    store = MongoStore.in_memory()
+    yield store
+    store.close()
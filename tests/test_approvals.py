@@ -0,0 +1,31 @@
+import asyncio
+
+from colorgame import ApprovalQueue
+
+
+def test_a_request_is_approved_once(store):
+    async def run():
+        approvals = ApprovalQueue(store)
+        await approvals.submit(1, kind="withdraw", user_id=7, amount=50)
+
+        claimed = await approvals.claim(1, admin_id=3)
+        assert claimed["amount"] == 50
+        assert await approvals.claim(1, admin_id=4) is None
+        assert (await store.approvals.find_one({"_id": 1}))["approved_by"] == 3
+        assert await approvals.pending_ids() == []
+
+    asyncio.run(run())
+
+
+def test_overdue_requests_expire_and_cannot_be_claimed(store):
+    async def run():
+        approvals = ApprovalQueue(store, ttl=-1)
+        await approvals.submit(1, kind="withdraw", user_id=7, amount=50)
+        await ApprovalQueue(store).submit(2, kind="redeem", user_id=8, amount=20)
+
+        assert [request["_id"] for request in await approvals.expire()] == [1]
+        assert await approvals.expire() == []
+        assert await approvals.claim(1, admin_id=3) is None
+        assert await approvals.pending_ids() == [2]
+
+    asyncio.run(run())
@@ -0,0 +1,67 @@
+import asyncio
+import datetime
+
+from colorgame import ProfitCounters, StatsRollups
+from colorgame_archive import SeasonArchiver
+from colorgame_ledger import BalanceService, TransactionLedger
+
+
+def archiver(store, batch_size=1000):
+    profits = ProfitCounters(store, StatsRollups(store))
+    balances = BalanceService(store, ledger=TransactionLedger(store))
+    return SeasonArchiver(store, balances, profits, batch_size=batch_size, pause=0), profits
+
+
+def test_profit_reset_clears_amounts_of_expired_logs(store):
+    async def run():
+        season, profits = archiver(store)
+        await profits.seed()
+        now = datetime.datetime.now()
+        await profits.record("lost", [{"user_id": user_id, "amount": 10, "date": now} for user_id in range(5)])
+        # Log retention's TTL index deletes rows without touching the counters
+        await store.lost_bets.delete_many({"user_id": {"$lt": 2}})
+
+        await season.run(await season.start(["profits"]))
+
+        assert await profits.read() == {"given": 0, "lost": 0, "redeemed": 0}
+        assert await season.archive(1, "lost_bets").count_documents({}) == 3
+
+    asyncio.run(run())
+
+
+def test_interrupted_job_is_resumed_from_its_cursor(store):
+    async def run():
+        season, profits = archiver(store, batch_size=2)
+        season.lease = -1
+        for user_id in range(5):
+            await season.balances.credit(user_id, 10 + user_id)
+        await store.roll_history.insert_many([{"results": ["red", "blue", "green"]} for _ in range(3)])
+
+        class Stopped(Exception):
+            pass
+
+        async def stop(job):
+            raise Stopped
+
+        job = await season.start(["balances", "history"], rollover=True)
+        try:
+            await season.run(job, progress=stop)
+        except Stopped:
+            pass
+        assert await season.start(["history"]) is None
+
+        claimed = await season.claim_stale()
+        assert claimed["moved"] == {"users": 2, "roll_history": 0}
+        await season.run(claimed)
+
+        finished = await store.archive_jobs.find_one({"_id": job["_id"]})
+        assert finished["status"] == "finished"
+        assert finished["moved"] == {"users": 5, "roll_history": 3}
+        assert [user["balance"] for user in await store.users.find({})] == [0] * 5
+        archived = await season.archive(1, "balances").find({})
+        assert sorted(document["balance"] for document in archived) == [10, 11, 12, 13, 14]
+        assert await store.roll_history.count_documents({}) == 0
+        assert (await season.season())["number"] == 2
+        assert await season.claim_stale() is None
+
+    asyncio.run(run())
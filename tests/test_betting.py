@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from colorgame import BettingRound, BettingTable, BetRejected
+from colorgame_ledger import BalanceService, TransactionLedger
+
+
+def table_and_balances(store):
+    return BettingTable(store, channel_id=10, guild_id=1), BalanceService(store, ledger=TransactionLedger(store))
+
+
+async def placed_bet(store, table, balances, amount=40):
+    await balances.credit(1, 100)
+    await table.open_round()
+    await table.place_bet(balances, 1, "red", amount)
+    [bet] = await table.round_bets({"user_id": 1})
+    return bet
+
+
+def test_cancel_refunds_once(store):
+    async def run():
+        table, balances = table_and_balances(store)
+        bet = await placed_bet(store, table, balances)
+        await table.cancel_bet(balances, bet)
+        assert await balances.get(1) == 100
+        assert table.current_round.ledger.user_total(1) == 0
+        with pytest.raises(BetRejected) as rejected:
+            await table.cancel_bet(balances, bet)
+        assert rejected.value.reason == "gone"
+        assert await balances.get(1) == 100
+        assert await store.ledger.count_documents({"type": "refund", "bet_id": bet["_id"]}) == 1
+
+    asyncio.run(run())
+
+
+def test_cancel_rejects_bets_of_settling_and_settled_rounds(store):
+    async def run():
+        table, balances = table_and_balances(store)
+        bet = await placed_bet(store, table, balances)
+        betting_round = table.current_round
+        assert await table.start_settling(betting_round, ("blue", "blue", "blue"))
+        with pytest.raises(BetRejected) as rejected:
+            await table.cancel_bet(balances, bet)
+        assert rejected.value.reason == "settling"
+
+        # A bet row left behind by a settled round must not be refunded
+        await store.rounds.update_one({"_id": betting_round.id}, {"$set": {"status": BettingRound.SETTLED}})
+        await table.finish_round(betting_round)
+        await store.bets.insert_one(bet)
+        with pytest.raises(BetRejected) as rejected:
+            await table.cancel_bet(balances, bet)
+        assert rejected.value.reason == "gone"
+        assert await balances.get(1) == 60
+        assert await store.bets.count_documents({"_id": bet["_id"]}) == 1
+
+    asyncio.run(run())
+
+
+def test_bets_lost_from_the_write_buffer_are_restored_from_the_ledger(store):
+    async def run():
+        table, balances = table_and_balances(store)
+        table.bet_writes.max_batch = 100
+        await balances.credit(1, 100)
+        await table.open_round()
+        await table.place_bet(balances, 1, "red", 10)
+        await table.place_bet(balances, 1, "blue", 20)
+        await table.bet_writes.flush()
+        [canceled] = await table.round_bets({"color": "blue"})
+        await table.cancel_bet(balances, canceled)
+        await table.place_bet(balances, 1, "green", 30)
+        table.bet_writes.pending.clear()  # The process stops before the buffer is flushed
+        table.bet_writes.timer.cancel()
+
+        restarted = BettingTable(store, channel_id=10, guild_id=1)
+        assert await restarted.restore_bets(table.current_round) == 1
+        assert await restarted.restore_bets(table.current_round) == 0
+        bets = await store.bets.find({}, sort=[("color", 1)])
+        assert [(bet["color"], bet["amount"]) for bet in bets] == [("green", 30), ("red", 10)]
+        assert await balances.get(1) == 60
+
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+
+from colorgame_ledger import BalanceService, TransactionLedger
+
+
+def books(store):
+    ledger = TransactionLedger(store)
+    return ledger, BalanceService(store, ledger=ledger)
+
+
+def test_replay_matches_balances_across_snapshots(store):
+    async def run():
+        ledger, balances = books(store)
+        await ledger.open_books()
+        await balances.credit(1, 100)
+        await balances.transfer(1, 2, 30)
+        assert await balances.debit(2, 50) is None
+        await ledger.snapshot()
+        await balances.adjust(1, -20)
+        await balances.credit_many({1: 5, 2: 5}, kind="win")
+        for user_id in (1, 2):
+            replayed, _ = await ledger.balance(user_id)
+            assert replayed == await balances.get(user_id)
+        assert (await ledger.totals())["gift"] == {"amount": 0, "count": 2}
+
+    asyncio.run(run())
+
+
+def test_snapshot_waits_for_entries_still_committing(store):
+    async def run():
+        ledger, balances = books(store)
+        await ledger.open_books()
+        await balances.credit(1, 10)
+
+        # Hold the next credit inside its transaction, after its entry id is taken but before the insert
+        gate = threading.Event()
+        insert = ledger.insert
+
+        def held_insert(entries, session):
+            gate.wait(5)
+            insert(entries, session)
+
+        ledger.insert = held_insert
+        credit = asyncio.create_task(balances.credit(1, 5))
+        await asyncio.sleep(0.05)
+        snapshot = asyncio.create_task(ledger.snapshot())
+        await asyncio.sleep(0.05)
+        gate.set()
+        await credit
+        assert await snapshot == 2  # Both credits, including the one that was still committing
+        ledger.insert = insert
+
+        assert (await ledger.balance(1))[0] == 15
+        await ledger.snapshot()
+        assert (await ledger.balance(1))[0] == 15
+
+    asyncio.run(run())
@@ -0,0 +1,55 @@
+import asyncio
+
+import discord
+
+from colorgame import MemberCache
+
+
+class Member:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.display_name = f"player{user_id}"
+
+
+class Guild:
+    id = 1
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.queries = 0
+
+    def get_member(self, user_id):
+        return None
+
+    async def query_members(self, user_ids=None, limit=5, cache=True):
+        self.queries += 1
+        if self.failures:
+            self.failures -= 1
+            raise asyncio.TimeoutError
+        return [Member(user_id) for user_id in user_ids if user_id != 3]
+
+
+def test_failed_query_is_retried_instead_of_cached():
+    async def run():
+        cache, guild = MemberCache(), Guild(failures=1)
+        assert await cache.resolve(guild, [1, 2, 3]) == {1: None, 2: None, 3: None}
+        assert await cache.resolve(guild, [1, 2, 3]) == {1: "player1", 2: "player2", 3: None}
+        assert await cache.resolve(guild, [1, 2, 3]) == {1: "player1", 2: "player2", 3: None}
+        assert guild.queries == 2  # Only the successful query's answers, unknown member included, were cached
+
+    asyncio.run(run())
+
+
+def test_client_exception_is_not_cached():
+    async def run():
+        cache, guild = MemberCache(), Guild()
+
+        async def fail(**kwargs):
+            raise discord.ClientException("intents")
+
+        guild.query_members, query = fail, guild.query_members
+        assert await cache.display_name(guild, 1) == "Unknown User"
+        guild.query_members = query
+        assert await cache.display_name(guild, 1) == "player1"
+
+    asyncio.run(run())